@@ -5,9 +5,17 @@ import threading
 import os
 import json
 from collections import namedtuple
+from urllib.parse import urljoin
+from requests.exceptions import HTTPError
 import rtde.rtde as rtde
 import rtde.rtde_config as rtde_config
 from octorest import OctoRest
+from mt_metrics import REGISTRY, TimedProxy, start_metrics_server, METRICS_HOST
+from mt_tuner import PickTempTuner, PICK_TEMP_MIN, PICK_TEMP_MAX, PICK_TEMP_STEP
+from mt_gcode import batch_offsets, batch_filename, write_batch_gcode, BATCH_BODY_START_MARKER, \
+    BATCH_BODY_END_MARKER, BATCH_LAYER_MARKER, BATCH_SPACING_X, BATCH_SPACING_Y, BATCH_COLUMNS, BATCH_BED_SIZE_X, \
+    BATCH_BED_SIZE_Y, BATCH_TRAVEL_CLEARANCE, MAX_BATCH_SIZE
+from mt_gcode_sync import GcodeManifest, MultipartFileStream, GCODE_CACHE_DIR
 
 # Default Parameters for RTDE (Cobot) Client
 ROBOT_HOST = "192.168.0.30"
@@ -19,7 +27,31 @@ OCTOPRINT_URL = "http://127.0.0.1:5000"
 GCODE_WITH_PRIME_LINE = "MT_prime_line.gcode"
 GCODE_NO_PRIME_LINE = "MT_no_prime_line.gcode"
 PRINTER_BED_TEMP_THRESHOLD = 40
+PRINTER_POLL_INTERVAL = 1
 WATCHDOG_TIMER_INTERVAL = 0.25
+PICK_TEMP_TUNING_FILE = "pick_temp_tuning.json"
+GCODE_DIR = "gcode"
+BATCH_SIZE = 1
+
+# Control loop metrics, served in Prometheus text format by mt_metrics
+CYCLES_COMPLETED = REGISTRY.counter('mt_cycles_completed_total', 'Machine tending cycles completed')
+PARTS_COMPLETED = REGISTRY.counter('mt_parts_completed_total', 'Parts removed from the printer bed')
+PHASE_DURATION = REGISTRY.histogram('mt_phase_duration_seconds', 'Duration of each machine tending cycle phase',
+                                    ['phase'], buckets=(30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 7200))
+OCTOPRINT_REQUEST_LATENCY = REGISTRY.histogram('mt_octoprint_request_seconds', 'OctoPrint API request latency',
+                                               ['method'])
+RTDE_RECEIVE_LATENCY = REGISTRY.histogram('mt_rtde_receive_seconds', 'RTDE state packet receive latency',
+                                          buckets=(0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+RTDE_PACKETS_RECEIVED = REGISTRY.counter('mt_rtde_packets_received_total', 'RTDE state packets received')
+WATCHDOG_KICK_INTERVAL = REGISTRY.histogram('mt_watchdog_kick_interval_seconds', 'Interval between cobot watchdog kicks',
+                                            buckets=(0.1, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1.0, 2.0))
+RTDE_RECONNECTS = REGISTRY.counter('mt_rtde_reconnects_total', 'RTDE reconnects after a broken pipe')
+PRINTER_BED_TEMP = REGISTRY.gauge('mt_printer_bed_temperature_celsius', 'Last reported printer bed temperature')
+PICK_TEMP_THRESHOLD = REGISTRY.gauge('mt_pick_temperature_threshold_celsius', 'Bed temperature at which parts are picked')
+COOLING_TIME_SAVED = REGISTRY.counter('mt_cooling_seconds_saved_total',
+                                      'Estimated cooling time saved by the pick temperature tuner')
+CONFIG_CHANGES_APPLIED = REGISTRY.counter('mt_config_changes_applied_total',
+                                          'Configuration changes applied while running')
 
 class AppConfig:
     def __init__(self, app_config_json, rtde_config_xml):
@@ -27,6 +59,8 @@ class AppConfig:
         config_data_from_json = json.load(open(app_config_json))
         print_to_stderr("App Configuration from json: \n{0}".format(str(config_data_from_json)))
 
+        self.app_config_json = app_config_json
+
         self.cobot_ip_address = config_data_from_json.get('cobot_ip_address', ROBOT_HOST )
         self.rtde_config_file = rtde_config_xml
         self.max_print_jobs = config_data_from_json.get('max_jobs', 1)
@@ -36,6 +70,113 @@ class AppConfig:
         self.gcode_with_prime_line = config_data_from_json.get('gcode_filename', GCODE_WITH_PRIME_LINE)
         self.gcode_no_prime_line = config_data_from_json.get('gcode_no_prime_filename', GCODE_NO_PRIME_LINE)
         self.watchdog_timer_interval = config_data_from_json.get('watchdog_timer_interval', WATCHDOG_TIMER_INTERVAL)
+        self.printer_poll_interval = config_data_from_json.get('printer_poll_interval', PRINTER_POLL_INTERVAL)
+        self.metrics_host = config_data_from_json.get('metrics_host', METRICS_HOST)
+        # the metrics exporter is off unless a port is configured
+        self.metrics_port = config_data_from_json.get('metrics_port')
+        self.pick_temp_tuning = config_data_from_json.get('pick_temp_tuning', False)
+        self.pick_temp_min = config_data_from_json.get('pick_temp_min', PICK_TEMP_MIN)
+        # None keeps the tuner within a small margin of printer_bed_pick_temp
+        self.pick_temp_max = config_data_from_json.get('pick_temp_max')
+        self.pick_temp_step = config_data_from_json.get('pick_temp_step', PICK_TEMP_STEP)
+        self.pick_temp_tuning_file = os.path.join(os.path.dirname(os.path.abspath(app_config_json)),
+                                                  config_data_from_json.get('pick_temp_tuning_file',
+                                                                            PICK_TEMP_TUNING_FILE))
+        self.gcode_dir = os.path.join(os.path.dirname(os.path.abspath(app_config_json)),
+                                      config_data_from_json.get('gcode_dir', GCODE_DIR))
+        self.batch_size = config_data_from_json.get('batch_size', BATCH_SIZE)
+        self.batch_columns = config_data_from_json.get('batch_columns', BATCH_COLUMNS)
+        self.batch_spacing_x = config_data_from_json.get('batch_spacing_x', BATCH_SPACING_X)
+        self.batch_spacing_y = config_data_from_json.get('batch_spacing_y', BATCH_SPACING_Y)
+        self.batch_bed_size_x = config_data_from_json.get('batch_bed_size_x', BATCH_BED_SIZE_X)
+        self.batch_bed_size_y = config_data_from_json.get('batch_bed_size_y', BATCH_BED_SIZE_Y)
+        self.batch_travel_clearance = config_data_from_json.get('batch_travel_clearance', BATCH_TRAVEL_CLEARANCE)
+        self.batch_body_start_marker = config_data_from_json.get('batch_body_start_marker', BATCH_BODY_START_MARKER)
+        self.batch_body_end_marker = config_data_from_json.get('batch_body_end_marker', BATCH_BODY_END_MARKER)
+        self.batch_layer_marker = config_data_from_json.get('batch_layer_marker', BATCH_LAYER_MARKER)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class LiveConfig:
+    # AppConfig fields that may change while the control loop is running, with their validity checks
+    # against the running AppConfig. Everything else (connections, batching, tuning, metrics) needs a restart.
+    LIVE_FIELDS = {
+        'max_print_jobs': lambda v, c: isinstance(v, int) and not isinstance(v, bool) and v >= 1,
+        'printer_bed_pick_temp': lambda v, c: is_number(v) and c.pick_temp_min <= v <= (
+            c.pick_temp_max if c.pick_temp_max is not None else PICK_TEMP_MAX),
+        'printer_poll_interval': lambda v, c: is_number(v) and v > 0,
+        'watchdog_timer_interval': lambda v, c: is_number(v) and 0.1 <= v <= 0.5,
+        'gcode_with_prime_line': lambda v, c: isinstance(v, str) and v != '',
+        'gcode_no_prime_line': lambda v, c: isinstance(v, str) and v != '',
+    }
+    GCODE_FIELDS = ('gcode_with_prime_line', 'gcode_no_prime_line')
+
+    def __init__(self, app_config):
+        self.app_config = app_config
+        self.mtime = self.get_mtime()
+        self.pending = None
+        self.reported = {}
+
+    def get_mtime(self):
+        try:
+            return os.path.getmtime(self.app_config.app_config_json)
+        except OSError:
+            return None
+
+    def poll(self):
+        mtime = self.get_mtime()
+        if mtime is None or mtime == self.mtime:
+            return
+        try:
+            self.pending = AppConfig(self.app_config.app_config_json, self.app_config.rtde_config_file)
+        except ValueError as e:
+            # most likely caught mid-write, try again at the next phase boundary
+            print_to_stderr("ignoring unreadable config file: {0}".format(e))
+            return
+        self.mtime = mtime
+
+    def report_once(self, field, value, message):
+        if self.reported.get(field) != value:
+            self.reported[field] = value
+            print_to_stderr(message)
+
+    def apply(self, cycle, fields):
+        """
+        Applies pending changes to the given live fields and returns the names of the fields changed.
+        """
+        self.poll()
+        if self.pending is None:
+            return []
+
+        changed = []
+        deferred = False
+        for field, old_value in vars(self.app_config).items():
+            new_value = getattr(self.pending, field)
+            if new_value == old_value:
+                continue
+            if field not in self.LIVE_FIELDS:
+                self.report_once(field, new_value, "config change to {0} requires a restart".format(field))
+            elif not self.LIVE_FIELDS[field](new_value, self.app_config):
+                self.report_once(field, new_value, "invalid config value {0}={1} ignored".format(field, new_value))
+            elif field not in fields:
+                deferred = True
+            else:
+                setattr(self.app_config, field, new_value)
+                changed.append(field)
+                CONFIG_CHANGES_APPLIED.inc()
+                print_to_stderr("config change applied at cycle {0}: {1} {2} -> {3}".format(
+                    cycle, field, old_value, new_value))
+        if not deferred:
+            self.pending = None
+        return changed
+
+    def revert(self, field, value):
+        self.report_once(field, getattr(self.app_config, field),
+                         "config change to {0} reverted to {1}".format(field, value))
+        setattr(self.app_config, field, value)
+
 
 def print_to_stderr(message):
     sys.stderr.write(message)
@@ -83,6 +224,15 @@ class CobotClient:
     PRINTER_STATUS_PRINTING = 2
     PRINTER_STATUS_INT_TO_TEXT = ["INITIALIZED", "IDLE", "PRINTING"]
 
+    # written by the cobot program to output_int_register_1 before it returns to idle
+    PICK_RESULT_UNKNOWN = 0
+    PICK_RESULT_SUCCESS = 1
+    PICK_RESULT_FAILURE = 2
+
+    # part count in input_int_register_1, part (x, y) offsets in metres from
+    # input_double_register_6 onwards (registers 0-5 belong to the setp recipe)
+    BATCH_POSITION_REGISTER = 6
+
     def __init__(self, app_config):
 
         print_to_stderr("Initializing Cobot Client Connection")
@@ -104,6 +254,7 @@ class CobotClient:
 
             # The function "rtde_set_watchdog" in the "rtde_control_loop.urp" creates a 1 Hz watchdog
             self.update_printer_status_register(CobotClient.PRINTER_STATUS_INITIALIZED)
+            self.update_batch_registers([(0.0, 0.0)])
 
         except rtde.RTDEException as err:
             print_to_stderr("Error initializing rtde connection with cobot: {}".format(err))
@@ -112,51 +263,84 @@ class CobotClient:
     def start_data_synchronization(self):
         if not self.con.send_start():
             # TBD: change to exception
-            sys.exit()
+            sys.exit(1)
+
+    def receive_state(self):
+        with RTDE_RECEIVE_LATENCY.time():
+            self.state = self.con.receive()
+        if self.state is not None:
+            RTDE_PACKETS_RECEIVED.inc()
+        return self.state
 
     def get_cobot_status(self):
-        self.state = self.con.receive()
+        self.receive_state()
         if self.state is None:
             # TBD fix this
-            sys.exit()
+            sys.exit(1)
         CobotStatus = namedtuple('CobotStatus', ['int', 'txt'])
         return CobotStatus(int=self.state.output_int_register_0,
                            txt=self.COBOT_STATUS_INT_TO_TEXT[self.state.output_int_register_0])
 
+    def get_pick_result(self):
+        # None when the cobot program does not report pick outcomes
+        pick_result = self.state.output_int_register_1
+        if pick_result == CobotClient.PICK_RESULT_SUCCESS:
+            return True
+        if pick_result == CobotClient.PICK_RESULT_FAILURE:
+            return False
+        return None
+
     def update_printer_status_register(self, value):
         self.watchdog.input_int_register_0 = value
         # note: we rely on watchdog kicker thread to send this to cobot
 
+    def update_batch_registers(self, offsets):
+        self.watchdog.input_int_register_1 = len(offsets)
+        for i in range(MAX_BATCH_SIZE):
+            x, y = offsets[i] if i < len(offsets) else (0.0, 0.0)
+            setattr(self.watchdog, "input_double_register_{0}".format(self.BATCH_POSITION_REGISTER + 2 * i), x / 1000)
+            setattr(self.watchdog, "input_double_register_{0}".format(self.BATCH_POSITION_REGISTER + 2 * i + 1), y / 1000)
+        # note: we rely on watchdog kicker thread to send this to cobot
+
     def send_printer_status(self):
         self.con.send(self.watchdog)
 
 
-def kick_cobot_watchdog(sleep_time, cobot_client, stop_thread_event, run_with_gui):
+def kick_cobot_watchdog(app_config, cobot_client, stop_thread_event, run_with_gui):
     # block for a moment
+    last_kick_time = None
     while not stop_thread_event.is_set():
         try:
-            cobot_client.state = cobot_client.con.receive()
+            cobot_client.receive_state()
             cobot_client.send_printer_status()
+            kick_time = time.perf_counter()
+            if last_kick_time is not None:
+                WATCHDOG_KICK_INTERVAL.observe(kick_time - last_kick_time)
+            last_kick_time = kick_time
             if run_with_gui:
                 print_to_stdout("current_time={0}".format(int(time.time())))
         except BrokenPipeError:
             print_to_stderr("broken pipe in kicker")
+            RTDE_RECONNECTS.inc()
             cobot_client.con.disconnect()
             cobot_client.con.connect()
             cobot_client.start_data_synchronization()
-        time.sleep(sleep_time)
+        # read on every pass so that live config changes take effect
+        time.sleep(app_config.watchdog_timer_interval)
         # display a message
     print_to_stderr('Cobot watchdog thread stopped')
 
 
 class PrinterClient:
-    PRINTER_POLL_INTERVAL = 1
 
     def __init__(self, app_config):
         print_to_stderr("Initializing OctoPrint Client Connection")
+        self.poll_interval = app_config.printer_poll_interval
 
         try:
-            self.con = OctoRest(url=app_config.octoprint_url, apikey=app_config.octoprint_api_key)
+            # session and url are read from the unwrapped client, only api calls are timed per method
+            self.octorest = OctoRest(url=app_config.octoprint_url, apikey=app_config.octoprint_api_key)
+            self.con = TimedProxy(self.octorest, OCTOPRINT_REQUEST_LATENCY)
             self.con.connect()
             print_to_stderr("Octoprint Version: {0}".format(self.get_server_version()))
         except Exception as e:
@@ -180,32 +364,220 @@ class PrinterClient:
         except Exception as e:
             print_to_stderr(e)
 
+    # the waits also sample the bed temperature, so the gauge stays current while printing
     def printer_cmd_wait(self, state):
         while self.con.state() == state:
-            time.sleep(self.PRINTER_POLL_INTERVAL)
+            self.get_bed_temp()
+            time.sleep(self.poll_interval)
 
     def printer_cmd_wait_until(self, state):
         while self.con.state() != state:
-            time.sleep(self.PRINTER_POLL_INTERVAL)
+            self.get_bed_temp()
+            time.sleep(self.poll_interval)
+
+    def get_bed_temp(self):
+        bed_temp = self.con.printer()['temperature']['bed']['actual']
+        PRINTER_BED_TEMP.set(bed_temp)
+        return bed_temp
 
     def printer_bed_temp_wait_until(self, threshold):
-        while self.con.printer()['temperature']['bed']['actual'] > threshold:
-            time.sleep(self.PRINTER_POLL_INTERVAL)
+        while self.get_bed_temp() > threshold:
+            time.sleep(self.poll_interval)
 
     def printer_stop(self):
         self.con.cancel()
 
+    def get_file_info(self, filename):
+        # looks up a single file rather than fetching the whole files('local') listing
+        try:
+            return self.con.files(filename)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def download_gcode(self, filename, path):
+        download_url = self.con.files(filename)['refs']['download']
+        with OCTOPRINT_REQUEST_LATENCY.labels('download').time():
+            with self.octorest.session.get(download_url, stream=True) as response:
+                response.raise_for_status()
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+
+    def upload_gcode(self, path):
+        # streamed from disk, large gcode files are never held in memory
+        body = MultipartFileStream(path)
+        with OCTOPRINT_REQUEST_LATENCY.labels('upload').time():
+            response = self.octorest.session.post(urljoin(self.octorest.url, '/api/files/local'), data=body,
+                                                  headers={'Content-Type': body.content_type})
+            response.raise_for_status()
+
 
 class ControlLoop:
 
     def __init__(self, app_config):
         self.app_config = app_config
 
-    def launch(self, run_with_gui):
+    def prepare_gcode_files(self, printer_client, cobot_client):
+        # Verify that the two print files (defined in the constant variables GCODE_WITH_PRIME_LINE and
+        # GCODE_WITHOUT_PRIME_LINE) have been uploaded to the Octoprint Server
+
+        if self.sync_gcode_files(printer_client,
+                                 (self.app_config.gcode_with_prime_line, self.app_config.gcode_no_prime_line)):
+            print_to_stderr("verified gcode files uploaded to Octoprint Server")
+        else:
+            print_to_stderr("gcode files missing from Octoprint Server")
+            return None
+
+        if self.app_config.batch_size > 1:
+            offsets = batch_offsets(self.app_config.batch_size, self.app_config.batch_columns,
+                                    self.app_config.batch_spacing_x, self.app_config.batch_spacing_y)
+            batch_filenames = self.prepare_batch_gcode(printer_client, offsets)
+            if batch_filenames is not None:
+                cobot_client.update_batch_registers(offsets)
+            return batch_filenames
+
+        return self.app_config.gcode_with_prime_line, self.app_config.gcode_no_prime_line
+
+    def sync_gcode_files(self, printer_client, gcode_filenames):
+        """
+        Makes sure each file is on the Octoprint Server. Where the operator has put a copy in gcode_dir,
+        the stored file must have the same hash, otherwise the local copy is uploaded. Copies downloaded
+        from the server live in the cache below gcode_dir and are never uploaded.
+        """
+        manifest = None
+        if os.path.isdir(self.app_config.gcode_dir):
+            manifest = GcodeManifest(self.app_config.gcode_dir)
+
+        for gcode_filename in gcode_filenames:
+            gcode_path = os.path.join(self.app_config.gcode_dir, gcode_filename)
+            remote_info = printer_client.get_file_info(gcode_filename)
+
+            if manifest is None or not os.path.exists(gcode_path):
+                if remote_info is None:
+                    print_to_stderr("{0} missing from Octoprint Server".format(gcode_filename))
+                    return False
+                continue
+
+            local_hash = manifest.local_hash(gcode_path)
+            if remote_info is None or remote_info.get('hash') != local_hash:
+                print_to_stderr("uploading {0} to Octoprint Server".format(gcode_filename))
+                printer_client.upload_gcode(gcode_path)
+                remote_info = printer_client.get_file_info(gcode_filename)
+                if remote_info is None or remote_info.get('hash') != local_hash:
+                    print_to_stderr("{0} on Octoprint Server does not match the local copy".format(gcode_filename))
+                    return False
+
+        if manifest is not None:
+            manifest.save()
+        return True
+
+    def apply_config_changes(self, live_config, cycle, fields, printer_client, pick_temp_tuner, run_with_gui):
+        changed = live_config.apply(cycle, fields)
+        if 'max_print_jobs' in changed and run_with_gui:
+            print_to_stdout("max_jobs={0}".format(self.app_config.max_print_jobs))
+        if 'printer_poll_interval' in changed:
+            printer_client.poll_interval = self.app_config.printer_poll_interval
+        if 'printer_bed_pick_temp' in changed and pick_temp_tuner is not None:
+            pick_temp_tuner.set_baseline(self.app_config.printer_bed_pick_temp)
+        return changed
+
+    def finished_print_on_bed(self, printer_client, *gcode_filenames):
+        # after a restart, a part is only assumed to be on the bed if OctoPrint shows one of our jobs completed
+        job_info = printer_client.con.job_info()
+        completion = job_info['progress']['completion'] or 0
+        return job_info['job']['file']['name'] in gcode_filenames and completion >= 100
+
+    def create_pick_temp_tuner(self, gcode_filename):
+        return PickTempTuner(self.app_config.pick_temp_tuning_file,
+                             "{0}/{1}".format(self.app_config.octoprint_url, gcode_filename),
+                             self.app_config.printer_bed_pick_temp,
+                             self.app_config.pick_temp_min,
+                             self.app_config.pick_temp_max,
+                             self.app_config.pick_temp_step)
+
+    def local_gcode_path(self, printer_client, gcode_filename):
+        """
+        Returns the operator's copy of the file in gcode_dir if there is one, otherwise a cached
+        download, refreshed whenever it no longer matches the file on the Octoprint Server.
+        """
+        gcode_path = os.path.join(self.app_config.gcode_dir, gcode_filename)
+        if os.path.exists(gcode_path):
+            return gcode_path
+
+        cache_dir = os.path.join(self.app_config.gcode_dir, GCODE_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest = GcodeManifest(cache_dir)
+        cache_path = os.path.join(cache_dir, gcode_filename)
+        remote_info = printer_client.get_file_info(gcode_filename)
+        if remote_info is None:
+            print_to_stderr("{0} missing from Octoprint Server".format(gcode_filename))
+            return None
+        if not os.path.exists(cache_path) or manifest.local_hash(cache_path) != remote_info.get('hash'):
+            print_to_stderr("downloading {0} from Octoprint Server".format(gcode_filename))
+            printer_client.download_gcode(gcode_filename, cache_path)
+            manifest.local_hash(cache_path)
+            manifest.save()
+        return cache_path
+
+    def prepare_batch_gcode(self, printer_client, offsets):
+        # tile the part onto the bed, keeping the prime line only in the first batch
+        os.makedirs(self.app_config.gcode_dir, exist_ok=True)
+        gcode_paths = {}
+        for gcode_filename in (self.app_config.gcode_with_prime_line, self.app_config.gcode_no_prime_line):
+            gcode_paths[gcode_filename] = self.local_gcode_path(printer_client, gcode_filename)
+            if gcode_paths[gcode_filename] is None:
+                return None
+
+        batch_filenames = []
+        for first_gcode_filename in (self.app_config.gcode_with_prime_line, self.app_config.gcode_no_prime_line):
+            batch_path = os.path.join(self.app_config.gcode_dir,
+                                      batch_filename(first_gcode_filename, len(offsets)))
+            try:
+                write_batch_gcode(batch_path,
+                                  gcode_paths[first_gcode_filename],
+                                  gcode_paths[self.app_config.gcode_no_prime_line],
+                                  offsets,
+                                  bed_size_x=self.app_config.batch_bed_size_x,
+                                  bed_size_y=self.app_config.batch_bed_size_y,
+                                  body_start_marker=self.app_config.batch_body_start_marker,
+                                  body_end_marker=self.app_config.batch_body_end_marker,
+                                  layer_marker=self.app_config.batch_layer_marker,
+                                  travel_clearance=self.app_config.batch_travel_clearance)
+            except ValueError as e:
+                print_to_stderr("cannot batch {0}: {1}".format(first_gcode_filename, e))
+                return None
+            batch_filenames.append(os.path.basename(batch_path))
+
+        # regenerated files hash the same as last time unless the sources or batch settings changed
+        if not self.sync_gcode_files(printer_client, batch_filenames):
+            return None
+        print_to_stderr("verified batch gcode files {0}".format(", ".join(batch_filenames)))
+        return batch_filenames
+
+    def launch(self, run_with_gui, completed_jobs=0, resume_phase=None):
+        """
+        completed_jobs and resume_phase come from the supervisor when it restarts a crashed control loop:
+        the job count carries on from where it left off, and a cycle interrupted in the given phase
+        (starting, printing, cooling, pick_and_place or picked) is rejoined rather than starting a new
+        print on top of its part. A part is only assumed to be on the bed if OctoPrint shows the job finished.
+        """
 
         # need to set up logging to stdout and stderr
 
         print_to_stderr("initializing mt control loop")
+        if self.app_config.metrics_port:
+            # metrics are diagnostic only, a failure to serve them must not stop the control loop
+            try:
+                start_metrics_server(self.app_config.metrics_host, self.app_config.metrics_port)
+                print_to_stderr("serving metrics on {0}:{1}".format(self.app_config.metrics_host,
+                                                                   self.app_config.metrics_port))
+            except OSError as e:
+                print_to_stderr("could not start metrics server: {0}".format(e))
+
         # make client to talk to Cobot
         cobot_client = CobotClient(self.app_config)
 
@@ -218,70 +590,152 @@ class ControlLoop:
         # create cobot watchdog kicker thread
         stop_thread_event = threading.Event()
         kicker_thread = threading.Thread(target=kick_cobot_watchdog,
-                                         args=(self.app_config.watchdog_timer_interval,
-                                               cobot_client, stop_thread_event, run_with_gui))
+                                         args=(self.app_config, cobot_client, stop_thread_event, run_with_gui),
+                                         daemon=True)
 
         # start data synchronization
         print_to_stderr("Start data synchronization with UR Cobot")
         cobot_client.start_data_synchronization()
         kicker_thread.start()
 
-        # Verify that the two print files (defined in the constant variables GCODE_WITH_PRIME_LINE and
-        # GCODE_WITHOUT_PRIME_LINE) have been uploaded to the Octoprint Server
-
-        file_names = {k['name'] for k in printer_client.con.files('local')['files']}
-        if (self.app_config.gcode_with_prime_line in file_names) and (self.app_config.gcode_no_prime_line in file_names):
-            print_to_stderr("verified gcode files uploaded to Octoprint Server")
-        else:
-            print_to_stderr("gcode files missing from Octoprint Server")
-            exit()
-
-        if printer_client.con.state() == 'Operational':
-
-            print_job_count = 0
+        batch_size = self.app_config.batch_size
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            print_to_stderr("batch size must be between 1 and {0}".format(MAX_BATCH_SIZE))
+            sys.exit(1)
+
+        gcode_files = self.prepare_gcode_files(printer_client, cobot_client)
+        if gcode_files is None:
+            sys.exit(1)
+        gcode_with_prime_line, gcode_no_prime_line = gcode_files
+
+        # picks up edits to app_config.json (e.g. saved from the GUI) at the next phase boundary
+        live_config = LiveConfig(self.app_config)
+        phase_fields = [field for field in LiveConfig.LIVE_FIELDS if field not in LiveConfig.GCODE_FIELDS]
+
+        pick_temp_tuner = None
+        if self.app_config.pick_temp_tuning:
+            pick_temp_tuner = self.create_pick_temp_tuner(gcode_no_prime_line)
+            print_to_stderr("pick temp tuning enabled, starting at {0} C".format(pick_temp_tuner.threshold))
+
+        printer_state = printer_client.con.state()
+        if printer_state == 'Printing' and resume_phase in ('starting', 'printing'):
+            resume_phase = 'printing'
+        elif printer_state == 'Operational' and resume_phase == 'starting':
+            # prints take far longer than a restart, so an idle printer means the start never took effect
+            resume_phase = None
+        elif (printer_state == 'Operational' and resume_phase in ('printing', 'cooling', 'pick_and_place') and
+              not self.finished_print_on_bed(printer_client, gcode_with_prime_line, gcode_no_prime_line)):
+            print_to_stderr("no finished print job to resume, starting a new cycle")
+            resume_phase = None
+
+        if printer_state == 'Operational' or (printer_state == 'Printing' and resume_phase == 'printing'):
+
+            print_job_count = completed_jobs
+            parts_completed = 0
+            control_loop_start_time = time.time()
             print_to_stderr("start machine tending control loop")
             if run_with_gui:
                 print_to_stdout("start_time={0}".format(int(time.time())))
+                print_to_stdout("max_jobs={0}".format(self.app_config.max_print_jobs))
+
+            if resume_phase == 'picked':
+                # the part was removed before the restart, only its outcome was not recorded
+                resume_phase = None
+                if cobot_client.get_pick_result() is False:
+                    print_to_stderr("cobot reported a failed pick, printer bed may not be clear, stopping control loop")
+                    stop_thread_event.set()
+                    return
+                print_job_count += 1
+                CYCLES_COMPLETED.inc()
+                PARTS_COMPLETED.inc(batch_size)
+                if run_with_gui:
+                    print_to_stdout("print_job_count={0}".format(print_job_count))
 
             while not killer.kill_now:
 
-                if print_job_count == 0:
-                    if run_with_gui:
-                        print_to_stdout("print_job_count={0}".format(print_job_count))
-                    # select print job for first pass
-                    printer_client.con.select(self.app_config.gcode_with_prime_line, print=False)
-                    time.sleep(1)
-                    selected_filename = printer_client.con.job_info()['job']['file']['name']
-                    assert selected_filename == self.app_config.gcode_with_prime_line
+                # the printer is idle between cycles, so gcode changes can be verified and uploaded here
+                old_gcode_files = [getattr(self.app_config, field) for field in LiveConfig.GCODE_FIELDS]
+                changed = self.apply_config_changes(live_config, print_job_count, LiveConfig.LIVE_FIELDS,
+                                                    printer_client, pick_temp_tuner, run_with_gui)
+                if print_job_count >= self.app_config.max_print_jobs:
+                    break
+                if any(field in changed for field in LiveConfig.GCODE_FIELDS):
+                    gcode_files = self.prepare_gcode_files(printer_client, cobot_client)
+                    if gcode_files is None:
+                        for field, value in zip(LiveConfig.GCODE_FIELDS, old_gcode_files):
+                            live_config.revert(field, value)
+                    else:
+                        gcode_with_prime_line, gcode_no_prime_line = gcode_files
+                        if pick_temp_tuner is not None:
+                            # tuning state is kept per gcode file, so pick up where the new part left off
+                            pick_temp_tuner = self.create_pick_temp_tuner(gcode_no_prime_line)
+                            print_to_stderr("pick temp tuning for {0}, starting at {1} C".format(
+                                gcode_no_prime_line, pick_temp_tuner.threshold))
+
+                if run_with_gui and (print_job_count == 0 or print_job_count == completed_jobs):
+                    print_to_stdout("print_job_count={0}".format(print_job_count))
 
                 print_start_time = int(time.time())
-                print_to_stderr('start new print job')
-
+                if resume_phase is None:
+                    # select print job for this pass, the prime line only on the first
+                    if print_job_count == 0:
+                        gcode_filename = gcode_with_prime_line
+                    else:
+                        gcode_filename = gcode_no_prime_line
+                    if printer_client.con.job_info()['job']['file']['name'] != gcode_filename:
+                        printer_client.con.select(gcode_filename, print=False)
+                        time.sleep(1)
+                        selected_filename = printer_client.con.job_info()['job']['file']['name']
+                        assert selected_filename == gcode_filename
+
+                    print_to_stderr('start new print job')
+                    if run_with_gui:
+                        print_to_stdout("cycle_phase=starting")
 
-                cobot_client.update_printer_status_register(CobotClient.PRINTER_STATUS_PRINTING)
+                    cobot_client.update_printer_status_register(CobotClient.PRINTER_STATUS_PRINTING)
 
-                printer_client.con.start()
-                time.sleep(5)
-                assert printer_client.con.state() == "Printing"
+                    printer_client.con.start()
+                    time.sleep(5)
+                    assert printer_client.con.state() == "Printing"
+                    if run_with_gui:
+                        print_to_stdout("cycle_phase=printing")
+                else:
+                    print_to_stderr("resuming print job {0} in phase {1}".format(print_job_count + 1, resume_phase))
                 printer_client.printer_cmd_wait('Printing')
 
                 print_to_stderr("print job complete")
-                print_to_stderr('waiting for bed to cool...')
-                printer_client.printer_bed_temp_wait_until(self.app_config.printer_bed_pick_temp)
-
-                bed_cooling_start_time = int(time.time())
+                self.apply_config_changes(live_config, print_job_count, phase_fields, printer_client, pick_temp_tuner,
+                                          run_with_gui)
+                if pick_temp_tuner is not None:
+                    pick_temp = pick_temp_tuner.threshold
+                else:
+                    pick_temp = self.app_config.printer_bed_pick_temp
+                PICK_TEMP_THRESHOLD.set(pick_temp)
+                if run_with_gui:
+                    print_to_stdout("pick_temp={0}".format(pick_temp))
 
+                print_to_stderr('waiting for bed to cool...')
+                if run_with_gui and resume_phase != 'pick_and_place':
+                    print_to_stdout("cycle_phase=cooling")
+                # the cooling phase runs from the end of the print until the cobot starts picking
+                cooling_wait_start_time = time.time()
+                bed_cooling_start_time = int(cooling_wait_start_time)
+                bed_temp_at_print_end = printer_client.get_bed_temp()
+                printer_client.printer_bed_temp_wait_until(pick_temp)
+
+                cooling_wait_seconds = time.time() - cooling_wait_start_time
+                cooling_rate = None
+                if bed_temp_at_print_end > pick_temp and cooling_wait_seconds > 0:
+                    cooling_rate = (bed_temp_at_print_end - pick_temp) / cooling_wait_seconds
+
+                # the finished job stays selected until the next cycle, so a restart can tell a part is on the bed
                 printer_client.printer_cmd_wait_until('Operational')
 
-                if print_job_count == 0:
-                    # select print job for subsequent passes
-                    printer_client.con.select(self.app_config.gcode_no_prime_line, print=False)
-                    time.sleep(1)
-                    selected_filename = printer_client.con.job_info()['job']['file']['name']
-                    assert selected_filename == self.app_config.gcode_no_prime_line
-
-                cobot_status = cobot_client.get_cobot_status()
-                assert cobot_status.int != CobotClient.COBOT_STATUS_PICKING
+                if resume_phase != 'pick_and_place':
+                    cobot_status = cobot_client.get_cobot_status()
+                    assert cobot_status.int != CobotClient.COBOT_STATUS_PICKING
+                    if run_with_gui:
+                        print_to_stdout("cycle_phase=pick_and_place")
                 cobot_client.update_printer_status_register(CobotClient.PRINTER_STATUS_IDLE)
                 while cobot_client.get_cobot_status().int != CobotClient.COBOT_STATUS_PICKING:
                     time.sleep(1)
@@ -303,27 +757,66 @@ class ControlLoop:
 
                 pick_and_place_finished_time = int(time.time())
                 print_to_stderr("item removed from printer bed")
+                if run_with_gui:
+                    print_to_stdout("cycle_phase=picked")
+
+                pick_succeeded = cobot_client.get_pick_result()
+                if pick_temp_tuner is not None:
+                    cooling_time_saved = pick_temp_tuner.record_pick(
+                        pick_succeeded, pick_and_place_finished_time - pick_and_place_start_time, cooling_rate)
+                    COOLING_TIME_SAVED.inc(cooling_time_saved)
+                    print_to_stderr("pick at {0} C {1}, next pick temp {2} C, cooling time saved {3:.0f} sec "
+                                    "(total {4:.0f} sec)".format(pick_temp,
+                                                                 {True: "succeeded", False: "failed",
+                                                                  None: "not reported"}[pick_succeeded],
+                                                                 pick_temp_tuner.threshold, cooling_time_saved,
+                                                                 pick_temp_tuner.cooling_time_saved))
+                if pick_succeeded is False:
+                    print_to_stderr("cobot reported a failed pick, printer bed may not be clear, stopping control loop")
+                    break
 
                 print_job_count += 1
+                parts_completed += batch_size
+                parts_per_hour = parts_completed * 3600 / (time.time() - control_loop_start_time)
+                CYCLES_COMPLETED.inc()
+                PARTS_COMPLETED.inc(batch_size)
+                if resume_phase is None:
+                    # a resumed cycle's timings start part way through, so they are left out of the phase stats
+                    PHASE_DURATION.labels('printing').observe(bed_cooling_start_time - print_start_time)
+                    PHASE_DURATION.labels('cooling').observe(pick_and_place_start_time - bed_cooling_start_time)
+                    PHASE_DURATION.labels('pick_and_place').observe(pick_and_place_finished_time - pick_and_place_start_time)
                 if run_with_gui:
                     print_to_stdout("print_job_count={0}".format(print_job_count))
-                    print_to_stdout("cycle_stats={0},{1},{2},{3}".format(print_start_time, bed_cooling_start_time, pick_and_place_start_time, pick_and_place_finished_time))
-
-                if print_job_count == self.app_config.max_print_jobs:
+                    if resume_phase is None:
+                        print_to_stdout("cycle_stats={0},{1},{2},{3}".format(print_start_time, bed_cooling_start_time, pick_and_place_start_time, pick_and_place_finished_time))
+                    print_to_stdout("parts_per_hour={0:.1f}".format(parts_per_hour))
+                resume_phase = None
+
+                self.apply_config_changes(live_config, print_job_count, phase_fields, printer_client, pick_temp_tuner,
+                                          run_with_gui)
+                if print_job_count >= self.app_config.max_print_jobs:
                     break
 
         else:
 
+            # exit non-zero so a supervisor retries once the printer is available again
             print_to_stderr("Printer busy, cannot start control loop")
+            stop_thread_event.set()
+            sys.exit(1)
 
         stop_thread_event.set()
 
 
 def main():
     args = sys.argv[1:]
+    if len(args) > 5 and args[5]:
+        # cpu affinity from the supervisor, set before any thread starts so they all inherit it
+        os.sched_setaffinity(0, {int(cpu) for cpu in args[5].split(',')})
     app_config = AppConfig(args[0], args[1])
     control_loop = ControlLoop(app_config)
-    control_loop.launch(args[2] == 'True')
+    completed_jobs = int(args[3]) if len(args) > 3 else 0
+    resume_phase = args[4] or None if len(args) > 4 else None
+    control_loop.launch(args[2] == 'True', completed_jobs, resume_phase)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+import os
+import re
+
+# Default Parameters for Batch G-Code generation
+BATCH_BODY_START_MARKER = ";LAYER:0"
+BATCH_BODY_END_MARKER = ";MT_BATCH_END"
+BATCH_LAYER_MARKER = ";LAYER:"
+BATCH_SPACING_X = 40.0
+BATCH_SPACING_Y = 40.0
+BATCH_COLUMNS = 3
+BATCH_BED_SIZE_X = 220.0
+BATCH_BED_SIZE_Y = 220.0
+BATCH_TRAVEL_CLEARANCE = 5.0
+BATCH_LIFT_FEEDRATE = 600
+BATCH_TRAVEL_FEEDRATE = 6000
+MAX_BATCH_SIZE = 6
+
+MOVE_COMMANDS = {'G0', 'G1', 'G2', 'G3', 'G00', 'G01', 'G02', 'G03'}
+AXIS_WORD = re.compile(r'([XYZEF])\s*([-+]?(?:\d+\.?\d*|\.\d+))', re.IGNORECASE)
+
+
+def batch_offsets(batch_size, columns=BATCH_COLUMNS, spacing_x=BATCH_SPACING_X, spacing_y=BATCH_SPACING_Y):
+    """
+    Returns the (x, y) offset in mm of each part in the batch, filling a grid row by row.
+    """
+    return [((i % columns) * spacing_x, (i // columns) * spacing_y) for i in range(batch_size)]
+
+
+def batch_filename(gcode_filename, batch_size):
+    return "batch{0}_{1}".format(batch_size, gcode_filename)
+
+
+def format_coordinate(value):
+    return "{0:.3f}".format(value).rstrip('0').rstrip('.')
+
+
+class GcodeOffsetter:
+    """
+    Shifts the X and Y coordinates of absolute moves, tracking G90/G91 and M82/M83 along with the
+    position, extruder position and feedrate the source gcode expects, and the highest Z reached.
+    """
+
+    def __init__(self, dx=0.0, dy=0.0):
+        self.absolute = True
+        self.absolute_e = True
+        self.x = None
+        self.y = None
+        self.z = 0.0
+        self.e = 0.0
+        self.feedrate = None
+        self.max_z = 0.0
+        self.dx = dx
+        self.dy = dy
+
+    def transform(self, line):
+        code, sep, comment = line.partition(';')
+        words = code.split()
+        if not words:
+            return line
+        command = words[0].upper()
+
+        if command == 'G90':
+            self.absolute = self.absolute_e = True
+        elif command == 'G91':
+            self.absolute = self.absolute_e = False
+        elif command == 'M82':
+            self.absolute_e = True
+        elif command == 'M83':
+            self.absolute_e = False
+        elif command in MOVE_COMMANDS or command == 'G92':
+            axes = {m.group(1).upper(): float(m.group(2)) for m in AXIS_WORD.finditer(code)}
+            self.track(command, axes)
+            if self.absolute and (self.dx or self.dy):
+                def shift(match):
+                    axis = match.group(1).upper()
+                    if axis not in 'XY':
+                        return match.group(0)
+                    return axis + format_coordinate(float(match.group(2)) + (self.dx if axis == 'X' else self.dy))
+                shifted = AXIS_WORD.sub(shift, code)
+                if shifted != code:
+                    return shifted.rstrip() + (' ' + sep + comment if sep else '\n')
+        return line
+
+    def track(self, command, axes):
+        # positions are kept in the source's coordinates, before any shift
+        relative = not self.absolute and command != 'G92'
+        if 'X' in axes:
+            self.x = (self.x or 0.0) + axes['X'] if relative else axes['X']
+        if 'Y' in axes:
+            self.y = (self.y or 0.0) + axes['Y'] if relative else axes['Y']
+        if 'Z' in axes:
+            self.z = self.z + axes['Z'] if relative else axes['Z']
+            if command != 'G92':
+                self.max_z = max(self.max_z, self.z)
+        if 'E' in axes and (self.absolute_e or command == 'G92'):
+            self.e = axes['E']
+        if 'F' in axes and command != 'G92':
+            self.feedrate = axes['F']
+
+
+def read_sections(gcode_file, body_start_marker, body_end_marker):
+    """
+    Streams (section, line) pairs, section being 'header', 'body' or 'footer'.
+    """
+    section = 'header'
+    with open(gcode_file) as f:
+        for line in f:
+            if section == 'header' and line.startswith(body_start_marker):
+                section = 'body'
+            elif section == 'body' and line.startswith(body_end_marker):
+                section = 'footer'
+            yield section, line
+    if section != 'footer':
+        raise ValueError("{0} does not contain the batch markers {1} and {2}".format(
+            gcode_file, body_start_marker, body_end_marker))
+
+
+def body_extents(gcode_file, body_start_marker=BATCH_BODY_START_MARKER, body_end_marker=BATCH_BODY_END_MARKER,
+                 layer_marker=BATCH_LAYER_MARKER):
+    """
+    Returns the XY bounding box (min_x, min_y, max_x, max_y) of the body's moves and its number of layers.
+    """
+    offsetter = GcodeOffsetter()
+    min_x = min_y = float('inf')
+    max_x = max_y = float('-inf')
+    layers = 0
+    for section, line in read_sections(gcode_file, body_start_marker, body_end_marker):
+        position = offsetter.x, offsetter.y
+        offsetter.transform(line)
+        if section != 'body':
+            continue
+        if line.startswith(layer_marker):
+            layers += 1
+        # count only where the body moves to, not where the start gcode left the nozzle
+        if (offsetter.x, offsetter.y) != position and offsetter.x is not None and offsetter.y is not None:
+            min_x, max_x = min(min_x, offsetter.x), max(max_x, offsetter.x)
+            min_y, max_y = min(min_y, offsetter.y), max(max_y, offsetter.y)
+    return (min_x, min_y, max_x, max_y), layers
+
+
+def check_batch(gcode_files, offsets, bed_size_x=BATCH_BED_SIZE_X, bed_size_y=BATCH_BED_SIZE_Y,
+                body_start_marker=BATCH_BODY_START_MARKER, body_end_marker=BATCH_BODY_END_MARKER,
+                layer_marker=BATCH_LAYER_MARKER):
+    """
+    Raises ValueError unless every copy of the part lands on the bed without overlapping
+    another, and the gcode marks its layers so the copies can be printed a layer at a time.
+    """
+    for gcode_file in gcode_files:
+        (min_x, min_y, max_x, max_y), layers = body_extents(gcode_file, body_start_marker, body_end_marker,
+                                                           layer_marker)
+        if layers == 0:
+            raise ValueError("{0} has no {1} layer markers, so the batch cannot be printed a layer at a time".format(
+                gcode_file, layer_marker))
+        for index, (dx, dy) in enumerate(offsets):
+            if min_x + dx < 0 or min_y + dy < 0 or max_x + dx > bed_size_x or max_y + dy > bed_size_y:
+                raise ValueError("part {0} of the batch from {1} would extend past the {2} x {3} mm bed".format(
+                    index, gcode_file, format_coordinate(bed_size_x), format_coordinate(bed_size_y)))
+            for other, (other_dx, other_dy) in enumerate(offsets[:index]):
+                if abs(dx - other_dx) <= max_x - min_x and abs(dy - other_dy) <= max_y - min_y:
+                    raise ValueError("parts {0} and {1} of the batch from {2} would overlap, increase the "
+                                     "batch spacing".format(other, index, gcode_file))
+
+
+class BatchPart:
+    """
+    One copy of the part in a batch, read from its gcode file a layer at a time.
+    """
+
+    def __init__(self, gcode_file, offset, body_start_marker, body_end_marker, layer_marker):
+        self.offsetter = GcodeOffsetter(*offset)
+        self.layer_marker = layer_marker
+        self.sections = read_sections(gcode_file, body_start_marker, body_end_marker)
+        self.advance()
+
+    def advance(self):
+        self.section, self.line = next(self.sections, (None, None))
+
+    def read_header(self):
+        # the start gcode is not shifted, but the offsetter still follows it
+        while self.section == 'header':
+            self.offsetter.transform(self.line)
+            yield self.line
+            self.advance()
+        # only the printed parts need clearing, not wherever the start gcode parked the nozzle
+        self.offsetter.max_z = 0.0
+
+    def read_layer(self):
+        # the body start marker opens the first layer, and each layer marker after it the next
+        first = True
+        while self.section == 'body' and (first or not self.line.startswith(self.layer_marker)):
+            yield self.offsetter.transform(self.line)
+            self.advance()
+            first = False
+
+    def read_footer(self):
+        while self.section == 'footer':
+            yield self.line
+            self.advance()
+
+    def resume(self, index, travel_z):
+        """
+        Lifts the nozzle to travel_z, travels to where this copy left off and restores its
+        height, positioning modes, extruder position and feedrate.
+        """
+        offsetter = self.offsetter
+        yield ";MT_BATCH_PART:{0}\n".format(index)
+        yield "G90\n"
+        yield "G0 F{0} Z{1}\n".format(BATCH_LIFT_FEEDRATE, format_coordinate(travel_z))
+        if offsetter.x is not None and offsetter.y is not None:
+            yield "G0 F{0} X{1} Y{2}\n".format(BATCH_TRAVEL_FEEDRATE, format_coordinate(offsetter.x + offsetter.dx),
+                                               format_coordinate(offsetter.y + offsetter.dy))
+        yield "G0 F{0} Z{1}\n".format(BATCH_LIFT_FEEDRATE, format_coordinate(offsetter.z))
+        if offsetter.absolute_e:
+            yield "M82\n"
+            yield "G92 E{0:.5f}\n".format(offsetter.e)
+        else:
+            yield "M83\n"
+        if offsetter.feedrate is not None:
+            yield "G1 F{0}\n".format(format_coordinate(offsetter.feedrate))
+        if not offsetter.absolute:
+            yield "G91\n"
+
+
+def tile_gcode(first_gcode_file, gcode_file, offsets, body_start_marker=BATCH_BODY_START_MARKER,
+               body_end_marker=BATCH_BODY_END_MARKER, layer_marker=BATCH_LAYER_MARKER,
+               travel_clearance=BATCH_TRAVEL_CLEARANCE):
+    """
+    Streams a single job printing one copy of the part at each offset, a layer at a time: each
+    layer is printed on every copy before the next one starts, so the nozzle and gantry never
+    pass below the top of a copy. Between copies the nozzle lifts travel_clearance above the
+    batch. The header (start gcode, including any prime line) comes from first_gcode_file and
+    the footer from the copy printed last.
+    """
+    parts = [BatchPart(first_gcode_file if index == 0 else gcode_file, offset, body_start_marker,
+                       body_end_marker, layer_marker) for index, offset in enumerate(offsets)]
+    for line in parts[0].read_header():
+        yield line
+    for part in parts[1:]:
+        for _ in part.read_header():
+            pass
+
+    current = 0
+    while any(part.section == 'body' for part in parts):
+        for index, part in enumerate(parts):
+            if part.section != 'body':
+                continue
+            if index != current:
+                travel_z = max(other.offsetter.max_z for other in parts) + travel_clearance
+                for line in part.resume(index, travel_z):
+                    yield line
+                current = index
+            for line in part.read_layer():
+                yield line
+
+    for line in parts[current].read_footer():
+        yield line
+    for part in parts:
+        part.sections.close()
+
+
+def write_batch_gcode(output_file, first_gcode_file, gcode_file, offsets, bed_size_x=BATCH_BED_SIZE_X,
+                      bed_size_y=BATCH_BED_SIZE_Y, body_start_marker=BATCH_BODY_START_MARKER,
+                      body_end_marker=BATCH_BODY_END_MARKER, layer_marker=BATCH_LAYER_MARKER,
+                      travel_clearance=BATCH_TRAVEL_CLEARANCE):
+    """
+    Raises ValueError, leaving output_file as it was, if the batch cannot be printed safely.
+    """
+    check_batch((first_gcode_file, gcode_file), offsets, bed_size_x, bed_size_y, body_start_marker,
+                body_end_marker, layer_marker)
+    tmp_file = output_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            for line in tile_gcode(first_gcode_file, gcode_file, offsets, body_start_marker, body_end_marker,
+                                   layer_marker, travel_clearance):
+                f.write(line)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, output_file)
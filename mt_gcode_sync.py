@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import uuid
+
+GCODE_MANIFEST_FILE = "gcode_manifest.json"
+GCODE_CACHE_DIR = "cache"
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def file_sha1(path):
+    # OctoPrint identifies stored files by their sha1
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class GcodeManifest:
+    """
+    Caches the hash of each local gcode file, keyed on its size and mtime.
+    """
+
+    def __init__(self, gcode_dir):
+        self.manifest_file = os.path.join(gcode_dir, GCODE_MANIFEST_FILE)
+        # only a cache of hashes, so an unreadable manifest just means hashing the files again
+        try:
+            with open(self.manifest_file) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+
+    def local_hash(self, path):
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = self.entries.get(name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['hash']
+        file_hash = file_sha1(path)
+        self.entries[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash}
+        return file_hash
+
+    def save(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+
+class MultipartFileStream:
+    """
+    File-like multipart/form-data body for uploading a file without reading it into memory.
+    Its length is known up front, so requests sends a Content-Length rather than chunking.
+    """
+
+    def __init__(self, path, field_name='file'):
+        self.boundary = uuid.uuid4().hex
+        self.path = path
+        preamble = ('--{0}\r\n'
+                    'Content-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n').format(self.boundary, field_name,
+                                                                             os.path.basename(path))
+        self.parts = [preamble.encode('utf8'), None, '\r\n--{0}--\r\n'.format(self.boundary).encode('utf8')]
+        self.length = len(self.parts[0]) + os.path.getsize(path) + len(self.parts[2])
+        self.part_index = 0
+        self.offset = 0
+        self.file = None
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.read(HASH_CHUNK_SIZE), b'')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = b''
+        while len(data) < size and self.part_index < len(self.parts):
+            part = self.parts[self.part_index]
+            if part is None:
+                if self.file is None:
+                    self.file = open(self.path, 'rb')
+                chunk = self.file.read(size - len(data))
+                if not chunk:
+                    self.file.close()
+                    self.part_index += 1
+                data += chunk
+            else:
+                chunk = part[self.offset:self.offset + size - len(data)]
+                self.offset += len(chunk)
+                if self.offset >= len(part):
+                    self.part_index += 1
+                    self.offset = 0
+                data += chunk
+        return data
@@ -6,9 +6,11 @@ import json
 from PyQt5.QtCore import Qt, QProcess
 from PyQt5.QtGui import QPixmap, QPainter
 from PyQt5.QtWidgets import QMainWindow, QLabel, QApplication, QGridLayout, QWidget, QPushButton, \
-    QPlainTextEdit, QMessageBox, QLineEdit, QVBoxLayout, QHBoxLayout, QSpinBox, QTabWidget, QDoubleSpinBox
+    QPlainTextEdit, QMessageBox, QLineEdit, QVBoxLayout, QHBoxLayout, QSpinBox, QTabWidget, QDoubleSpinBox, QCheckBox
 from PyQt5.QtChart import QChart, QChartView, QBarSet, QBarCategoryAxis, QStackedBarSeries, QValueAxis
 
+from mt_stats import CycleStatsEngine
+
 APP_CONFIG_JSON = 'app_config.json'
 
 GLOBAL_STYLE = """ QLineEdit, QPlainTextEdit, QSpinBox, QDoubleSpinBox { 
@@ -57,6 +59,12 @@ class MainWindow(QMainWindow):
 
         self.start_time = None
         self.p = None
+        self.cycle_stats_engine = CycleStatsEngine()
+        self.completed_jobs = 0
+        # max_jobs as the running control loop sees it, which may differ from unsaved edits
+        self.running_max_jobs = None
+        self.eta = None
+        self.eta_time = None
 
         self.setWindowTitle("APM Machine Tending Exhibit")
 
@@ -149,6 +157,20 @@ class MainWindow(QMainWindow):
         self.printer_bed_pick_temp.setValue(self.app_config.get('printer_bed_pick_temp', 40))
         self.printer_bed_pick_temp.valueChanged.connect(self.printer_bed_pick_temp_changed)
 
+        self.pick_temp_tuning_label = QLabel("Self-tune Printer Bed Pick Temp")
+        self.pick_temp_tuning = QCheckBox()
+        self.pick_temp_tuning.setToolTip("Adjust the pick temp from the outcome of each pick, starting from the value above")
+        self.pick_temp_tuning.setChecked(self.app_config.get('pick_temp_tuning', False))
+        self.pick_temp_tuning.stateChanged.connect(self.pick_temp_tuning_changed)
+
+        self.batch_size_label = QLabel("Parts per Batch")
+        self.batch_size = QSpinBox()
+        self.batch_size.setMinimum(1)
+        self.batch_size.setMaximum(6)
+        self.batch_size.setToolTip("Print several copies of the part in one job, picked in a single cobot visit")
+        self.batch_size.setValue(self.app_config.get('batch_size', 1))
+        self.batch_size.valueChanged.connect(self.batch_size_changed)
+
         self.max_cycle_time_label = QLabel("Max cycle time (for bar chart display)")
         self.max_cycle_time = QSpinBox()
         self.max_cycle_time.setSingleStep(1)
@@ -180,6 +202,18 @@ class MainWindow(QMainWindow):
         self.run_time_label = QLabel("Control Loop Run Time:")
         self.run_time = QLineEdit()
         self.run_time.setReadOnly(True)
+        self.eta_label = QLabel("Estimated Time Remaining:")
+        self.eta_display = QLineEdit()
+        self.eta_display.setReadOnly(True)
+        self.drift_label = QLabel("Phase Drift:")
+        self.drift_display = QLineEdit()
+        self.drift_display.setReadOnly(True)
+        self.parts_per_hour_label = QLabel("Parts per Hour:")
+        self.parts_per_hour = QLineEdit()
+        self.parts_per_hour.setReadOnly(True)
+        self.pick_temp_label = QLabel("Current Pick Temp:")
+        self.pick_temp = QLineEdit()
+        self.pick_temp.setReadOnly(True)
 
         self.series = QStackedBarSeries()
 
@@ -220,6 +254,14 @@ class MainWindow(QMainWindow):
         session_stats_layout.addWidget(self.last_completed_job_time, 1, 1)
         session_stats_layout.addWidget(self.run_time_label, 2, 0)
         session_stats_layout.addWidget(self.run_time, 2, 1)
+        session_stats_layout.addWidget(self.eta_label, 3, 0)
+        session_stats_layout.addWidget(self.eta_display, 3, 1)
+        session_stats_layout.addWidget(self.drift_label, 4, 0)
+        session_stats_layout.addWidget(self.drift_display, 4, 1)
+        session_stats_layout.addWidget(self.parts_per_hour_label, 5, 0)
+        session_stats_layout.addWidget(self.parts_per_hour, 5, 1)
+        session_stats_layout.addWidget(self.pick_temp_label, 6, 0)
+        session_stats_layout.addWidget(self.pick_temp, 6, 1)
 
         grid_layout_basic_config_fields = QGridLayout()
         grid_layout_basic_config_fields.addWidget(self.max_jobs_label, 1, 0)
@@ -230,8 +272,12 @@ class MainWindow(QMainWindow):
         grid_layout_basic_config_fields.addWidget(self.gcode_no_prime_line, 3, 1)
         grid_layout_basic_config_fields.addWidget(self.printer_bed_pick_temp_label, 4, 0)
         grid_layout_basic_config_fields.addWidget(self.printer_bed_pick_temp, 4, 1)
-        grid_layout_basic_config_fields.addWidget(self.max_cycle_time_label, 5, 0)
-        grid_layout_basic_config_fields.addWidget(self.max_cycle_time, 5, 1)
+        grid_layout_basic_config_fields.addWidget(self.pick_temp_tuning_label, 5, 0)
+        grid_layout_basic_config_fields.addWidget(self.pick_temp_tuning, 5, 1)
+        grid_layout_basic_config_fields.addWidget(self.batch_size_label, 6, 0)
+        grid_layout_basic_config_fields.addWidget(self.batch_size, 6, 1)
+        grid_layout_basic_config_fields.addWidget(self.max_cycle_time_label, 7, 0)
+        grid_layout_basic_config_fields.addWidget(self.max_cycle_time, 7, 1)
 
         grid_layout_advanced_config_fields = QGridLayout()
         grid_layout_advanced_config_fields.addWidget(self.cobot_ip_address_label, 0, 0)
@@ -297,62 +343,69 @@ class MainWindow(QMainWindow):
 
         self.setCentralWidget(tabs)
 
+        # fields the control loop only reads at launch
+        self.restart_config_widgets = [self.cobot_ip_address, self.octoprint_api_key, self.octoprint_url,
+                                       self.pick_temp_tuning, self.batch_size]
+
     def stderr_message(self, s):
         self.stderr_display.appendPlainText(s)
 
-    def cobot_ip_address_edited(self, s):
-        self.app_config['cobot_ip_address'] = s
-        self.run_widget.setDisabled(True)
+    def config_edited(self):
+        # while the control loop is running, saved changes are picked up by it at the next phase boundary
+        if self.p is None:
+            self.run_widget.setDisabled(True)
         self.save_config_button.setDisabled(False)
         self.cancel_config_button.setDisabled(False)
 
+    def set_running(self, running):
+        self.start_button.setDisabled(running)
+        self.stop_button.setDisabled(not running)
+        for widget in self.restart_config_widgets:
+            widget.setDisabled(running)
+
+    def cobot_ip_address_edited(self, s):
+        self.app_config['cobot_ip_address'] = s
+        self.config_edited()
+
     def max_jobs_changed(self, n):
         self.app_config['max_jobs'] = n
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def max_cycle_time_changed(self, n):
         self.app_config['max_cycle_time'] = n
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def gcode_filename_edited(self, s):
         self.app_config['gcode_filename'] = s
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def gcode_no_prime_filename_edited(self, s):
         self.app_config['gcode_no_prime_filename'] = s
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def octoprint_api_key_edited(self, s):
         self.app_config['octoprint_api_key'] = s
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def octoprint_url_edited(self, s):
         self.app_config['octoprint_url'] = s
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def printer_bed_pick_temp_changed(self, n):
         self.app_config['printer_bed_pick_temp'] = n
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
+
+    def pick_temp_tuning_changed(self, state):
+        self.app_config['pick_temp_tuning'] = state == Qt.Checked
+        self.config_edited()
+
+    def batch_size_changed(self, n):
+        self.app_config['batch_size'] = n
+        self.config_edited()
 
     def watchdog_timer_interval_edited(self, x):
         self.app_config['watchdog_timer_interval'] = x
-        self.run_widget.setDisabled(True)
-        self.save_config_button.setDisabled(False)
-        self.cancel_config_button.setDisabled(False)
+        self.config_edited()
 
     def on_save_config_click(self):
         json.dump(self.app_config, open(self.app_config_json, 'w'))
@@ -373,8 +426,7 @@ class MainWindow(QMainWindow):
         self.axisY.setTitleText("Minutes")
         self.bc_widget.setAxisY(self.axisY, self.series)
 
-        self.start_button.setDisabled(False)
-        self.stop_button.setDisabled(True)
+        self.set_running(self.p is not None)
         self.run_widget.setDisabled(False)
         self.save_config_button.setDisabled(True)
         self.cancel_config_button.setDisabled(True)
@@ -388,11 +440,12 @@ class MainWindow(QMainWindow):
         self.octoprint_api_key.setText(self.app_config.get('octoprint_api_key', ''))
         self.octoprint_url.setText(self.app_config.get("octoprint_url", "127.0.0.1:5000"))
         self.printer_bed_pick_temp.setValue(self.app_config.get('printer_bed_pick_temp', 40))
+        self.pick_temp_tuning.setChecked(self.app_config.get('pick_temp_tuning', False))
+        self.batch_size.setValue(self.app_config.get('batch_size', 1))
         self.max_cycle_time.setValue(self.app_config.get('max_cycle_time', 20))
         self.watchdog_timer_interval.setValue(self.app_config.get("watchdog_timer_interval", 0.25))
 
-        self.start_button.setDisabled(False)
-        self.stop_button.setDisabled(True)
+        self.set_running(self.p is not None)
         self.run_widget.setDisabled(False)
         self.save_config_button.setDisabled(True)
         self.cancel_config_button.setDisabled(True)
@@ -421,6 +474,16 @@ class MainWindow(QMainWindow):
             self.job_count.clear()
             self.last_completed_job_time.clear()
             self.run_time.clear()
+            self.parts_per_hour.clear()
+            self.eta_display.clear()
+            self.drift_display.clear()
+            self.drift_display.setStyleSheet("")
+            self.cycle_stats_engine = CycleStatsEngine()
+            self.completed_jobs = 0
+            self.running_max_jobs = None
+            self.eta = None
+            self.eta_time = None
+            self.pick_temp.clear()
 
             self.p = QProcess()
             self.p.readyReadStandardOutput.connect(self.handle_stdout)
@@ -431,9 +494,7 @@ class MainWindow(QMainWindow):
                                     resource_path('control_loop_configuration.xml'),
                                     "True"])
 
-            self.start_button.setDisabled(True)
-            self.config_widget.setDisabled(True)
-            self.stop_button.setDisabled(False)
+            self.set_running(True)
 
     def on_stop_click(self):
         self.stop_button.setDisabled(True)
@@ -451,7 +512,6 @@ class MainWindow(QMainWindow):
             if self.p is not None:
                 self.p.kill()
             self.start_button.setDisabled(False)
-            self.config_widget.setDisabled(False)
         else:
             self.stop_button.setDisabled(False)
 
@@ -460,17 +520,55 @@ class MainWindow(QMainWindow):
         message = bytes(data).decode("utf8")
         self.stderr_message(message)
 
+    def get_running_max_jobs(self):
+        if self.running_max_jobs is not None:
+            return self.running_max_jobs
+        return self.app_config['max_jobs']
+
+    def update_eta(self, eta_time):
+        self.eta = self.cycle_stats_engine.eta(max(self.get_running_max_jobs() - self.completed_jobs, 0))
+        self.eta_time = eta_time
+        self.update_eta_display(eta_time)
+
+    def update_eta_display(self, now):
+        if self.eta is None:
+            return
+        estimate, low, high = self.eta
+        remaining_seconds = max(estimate - (now - self.eta_time), 0)
+        self.eta_display.setText("{0} (+/- {1})".format(datetime.timedelta(seconds=int(remaining_seconds)),
+                                                        datetime.timedelta(seconds=int((high - low) / 2))))
+
+    def update_drift_display(self):
+        drifting_phases = self.cycle_stats_engine.drifting_phases()
+        if drifting_phases:
+            self.drift_display.setText("{0} slower than usual".format(", ".join(drifting_phases).replace('_', ' ')))
+            self.drift_display.setStyleSheet("color: red")
+        else:
+            self.drift_display.setText("None")
+            self.drift_display.setStyleSheet("")
+
     def handle_stdout(self):
         result = bytes(self.p.readAllStandardOutput()).decode("utf8")
         data = extract_vars(result)
+        if 'max_jobs' in data:
+            self.running_max_jobs = int(data['max_jobs'])
+            if self.eta is not None:
+                self.update_eta(self.eta_time)
         if 'print_job_count' in data:
-            self.job_count.setText("{0} of {1}".format(data['print_job_count'], self.app_config['max_jobs']))
+            self.completed_jobs = int(data['print_job_count'])
+        if 'print_job_count' in data or 'max_jobs' in data:
+            self.job_count.setText("{0} of {1}".format(self.completed_jobs, self.get_running_max_jobs()))
         if 'start_time' in data:
             self.start_time = int(data['start_time'])
         if 'current_time' in data:
             if self.start_time is not None:
                 runtime_seconds = int(data['current_time']) - self.start_time
                 self.run_time.setText(str(datetime.timedelta(seconds=runtime_seconds)))
+            self.update_eta_display(int(data['current_time']))
+        if 'parts_per_hour' in data:
+            self.parts_per_hour.setText(data['parts_per_hour'])
+        if 'pick_temp' in data:
+            self.pick_temp.setText("{0} C".format(data['pick_temp']))
         if 'cycle_stats' in data:
             raw_cycle_stats = [int(i) for i in data['cycle_stats'].split(',')]
             cycle_runtime_seconds = raw_cycle_stats[-1] - raw_cycle_stats[0]
@@ -481,6 +579,10 @@ class MainWindow(QMainWindow):
             self.cooling_bar_set.append(cycle_stats[1])
             self.pick_and_place_bar_set.append(cycle_stats[2])
 
+            self.cycle_stats_engine.update(raw_cycle_stats)
+            self.update_eta(raw_cycle_stats[-1])
+            self.update_drift_display()
+
     def handle_state(self, state):
         states = {
             QProcess.NotRunning: 'Not running',
@@ -492,10 +594,8 @@ class MainWindow(QMainWindow):
 
     def process_finished(self, exit_code, exit_status):
         self.stderr_message("Process finished, exit code = {0}, exit status = {1}".format(exit_code, exit_status))
-        self.stop_button.setDisabled(True)
-        self.start_button.setDisabled(False)
-        self.config_widget.setDisabled(False)
         self.p = None
+        self.set_running(False)
         self.start_time = None
 
 
@@ -6,8 +6,9 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('control_loop_configuration.xml', '.'), ('small-block-logo.jpg', '.'),
-        ('mt_control_loop.py', '.'), ('universal lego brick v13.jpg', '.'), ('app_config.json', '.'),
-        ('UR logo.jpg', '.')],
+        ('mt_control_loop.py', '.'), ('mt_metrics.py', '.'), ('universal lego brick v13.jpg', '.'), ('app_config.json', '.'),
+        ('UR logo.jpg', '.'), ('mt_tuner.py', '.'), ('mt_gcode.py', '.'),
+        ('mt_gcode_sync.py', '.')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,258 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default Parameters for the metrics exporter
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *label_values):
+        # children are created once and cached, so hot paths only pay for a dict lookup
+        key = tuple(str(v) for v in label_values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default_child(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} {1}".format(self.name, self.TYPE)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for label_values, child in children:
+            lines.extend(child.expose(self.name, self.label_names, label_values))
+        return lines
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def expose(self, name, label_names, label_values):
+        return ["{0}{1} {2}".format(name, format_labels(label_names, label_values), format_value(self._value))]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+
+class _GaugeChild:
+
+    def __init__(self):
+        self._value = 0.0
+
+    def set(self, value):
+        # a single attribute store is atomic, no lock needed
+        self._value = float(value)
+
+    def expose(self, name, label_names, label_values):
+        return ["{0}{1} {2}".format(name, format_labels(label_names, label_values), format_value(self._value))]
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default_child().set(value)
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._upper_bounds = buckets
+        self._bucket_counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._bucket_counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def expose(self, name, label_names, label_values):
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self._upper_bounds + (float('inf'),), bucket_counts):
+            cumulative += count
+            lines.append("{0}_bucket{1} {2}".format(
+                name, format_labels(label_names, label_values, [('le', format_value(upper_bound))]), cumulative))
+        lines.append("{0}_sum{1} {2}".format(name, format_labels(label_names, label_values), format_value(total)))
+        lines.append("{0}_count{1} {2}".format(name, format_labels(label_names, label_values), cumulative))
+        return lines
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super(Histogram, self).__init__(name, documentation, label_names)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def time(self):
+        return self._default_child().time()
+
+
+class _Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        if not metric.label_names:
+            # export unlabelled metrics as 0 from the first scrape, rather than only after their first update
+            metric._default_child()
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class TimedProxy:
+    """
+    Wraps a client object and records the latency of every
+    attribute fetch and method call in a labelled histogram.
+    """
+
+    def __init__(self, target, histogram):
+        self._target = target
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        # properties (e.g. OctoRest.version) may issue requests themselves, so time the fetch too
+        start = time.perf_counter()
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            self._histogram.labels(name).observe(time.perf_counter() - start)
+            return attr
+
+        def timed_call(*args, **kwargs):
+            with self._histogram.labels(name).time():
+                return attr(*args, **kwargs)
+        return timed_call
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of stderr, which the GUI displays
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT, registry=REGISTRY):
+    handler = type('BoundMetricsRequestHandler', (MetricsRequestHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
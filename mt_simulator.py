@@ -0,0 +1,224 @@
+import argparse
+import heapq
+import itertools
+import math
+import random
+import statistics
+
+# Default Parameters for the Simulator
+SIMULATED_DAYS = 14
+BASELINE_PICK_TEMP = 40
+BED_TEMP = 60
+AMBIENT_TEMP = 22
+BED_COOLING_TIME_CONSTANT = 600
+PICK_FIXED_FRACTION = 0.5
+
+# named as in the control loop's cycle_stats and the GUI
+PHASES = ('printing', 'cooling', 'pick_and_place')
+
+
+def read_cycle_stats(log_file):
+    """
+    Reads the control loop's stdout (or the supervisor's, with cell-prefixed keys) and
+    returns the phase durations of each cycle along with any pick temps reported.
+    """
+    cycles = []
+    pick_temps = []
+    for line in open(log_file):
+        if '=' not in line:
+            continue
+        name, value = line.strip().split('=', 1)
+        name = name.rsplit('.', 1)[-1]
+        if name == 'cycle_stats':
+            timestamps = [int(i) for i in value.split(',')]
+            cycles.append([timestamps[i + 1] - timestamps[i] for i in range(len(timestamps) - 1)])
+        elif name == 'pick_temp':
+            pick_temps.append(float(value))
+    return cycles, pick_temps
+
+
+class PhaseDistribution:
+    """
+    Lognormal fitted to the recorded durations of one phase.
+    """
+
+    def __init__(self, durations):
+        logs = [math.log(max(d, 1)) for d in durations]
+        self.mu = statistics.mean(logs)
+        self.sigma = statistics.stdev(logs) if len(logs) > 1 else 0.0
+
+    def sample(self, rng):
+        return rng.lognormvariate(self.mu, self.sigma)
+
+
+def bed_cooling_time(pick_temp, bed_temp, ambient_temp, time_constant):
+    # Newton's law of cooling from the bed's print temperature down to the pick temperature
+    if pick_temp >= bed_temp:
+        return 0.0
+    return time_constant * math.log((bed_temp - ambient_temp) / (pick_temp - ambient_temp))
+
+
+class Scenario:
+
+    def __init__(self, printers, pick_temp, arm_speed, batch_size):
+        self.printers = printers
+        self.pick_temp = pick_temp
+        self.arm_speed = arm_speed
+        self.batch_size = batch_size
+
+
+class CellModel:
+    """
+    Phase durations for the print, cool, operational, pick and place steps of ControlLoop.launch,
+    fitted from recorded cycles. The recorded cooling phase runs from the end of the print until
+    the cobot starts picking, so the modelled bed cooling at the recorded pick temp is swapped
+    for the scenario's, leaving the printer returning to Operational and the cobot handshake.
+    The recorded durations already include the control loop's status polling.
+    """
+
+    def __init__(self, cycles, baseline_pick_temp, recorded_batch_size, bed_temp, ambient_temp, time_constant,
+                 pick_fixed_fraction=PICK_FIXED_FRACTION):
+        self.phases = {phase: PhaseDistribution([cycle[i] for cycle in cycles]) for i, phase in enumerate(PHASES)}
+        self.recorded_batch_size = recorded_batch_size
+        self.pick_fixed_fraction = pick_fixed_fraction
+        self.bed_temp = bed_temp
+        self.ambient_temp = ambient_temp
+        self.time_constant = time_constant
+        self.baseline_bed_cooling_time = self.bed_cooling_time(baseline_pick_temp)
+
+    def bed_cooling_time(self, pick_temp):
+        return bed_cooling_time(pick_temp, self.bed_temp, self.ambient_temp, self.time_constant)
+
+    def print_time(self, scenario, rng):
+        return self.phases['printing'].sample(rng) * scenario.batch_size / self.recorded_batch_size
+
+    def cooling_time(self, scenario, rng):
+        # bed cooling to the scenario's pick temp, then the printer back to Operational and the
+        # printer status register set to IDLE
+        handover_time = max(self.phases['cooling'].sample(rng) - self.baseline_bed_cooling_time, 0.0)
+        return self.bed_cooling_time(scenario.pick_temp) + handover_time
+
+    def pick_and_place_time(self, scenario, rng):
+        # one visit to the printer per batch: only the per-part share scales with the number of parts
+        pick_time = self.phases['pick_and_place'].sample(rng)
+        per_part_time = pick_time * (1 - self.pick_fixed_fraction) / self.recorded_batch_size
+        return (pick_time * self.pick_fixed_fraction + per_part_time * scenario.batch_size) / scenario.arm_speed
+
+
+class Simulation:
+    READY_FOR_PICK = 0
+    PICK_DONE = 1
+
+    def __init__(self, model, scenario, duration, seed):
+        self.model = model
+        self.scenario = scenario
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.events = []
+        self.sequence = itertools.count()
+        self.arm_queue = []
+        self.arm_busy = False
+        self.arm_busy_time = 0.0
+        self.queue_delays = []
+        self.parts_completed = 0
+        self.cycles_completed = 0
+
+    def schedule(self, time, event, printer):
+        heapq.heappush(self.events, (time, next(self.sequence), event, printer))
+
+    def start_cycle(self, now, printer):
+        ready_time = now + self.model.print_time(self.scenario, self.rng) + self.model.cooling_time(self.scenario,
+                                                                                                   self.rng)
+        self.schedule(ready_time, Simulation.READY_FOR_PICK, printer)
+
+    def start_pick(self, now, printer, requested_time):
+        self.arm_busy = True
+        self.queue_delays.append(now - requested_time)
+        pick_time = self.model.pick_and_place_time(self.scenario, self.rng)
+        self.arm_busy_time += min(pick_time, self.duration - now)
+        self.schedule(now + pick_time, Simulation.PICK_DONE, printer)
+
+    def run(self):
+        for printer in range(self.scenario.printers):
+            self.start_cycle(0.0, printer)
+
+        while self.events:
+            now, _, event, printer = heapq.heappop(self.events)
+            if now > self.duration:
+                break
+            if event == Simulation.READY_FOR_PICK:
+                if self.arm_busy:
+                    self.arm_queue.append((printer, now))
+                else:
+                    self.start_pick(now, printer, now)
+            else:
+                self.parts_completed += self.scenario.batch_size
+                self.cycles_completed += 1
+                self.arm_busy = False
+                self.start_cycle(now, printer)
+                if self.arm_queue:
+                    next_printer, requested_time = self.arm_queue.pop(0)
+                    self.start_pick(now, next_printer, requested_time)
+        return self
+
+    def report(self):
+        hours = self.duration / 3600
+        delays = sorted(self.queue_delays)
+        return {
+            'parts_per_hour': self.parts_completed / hours,
+            'cycles': self.cycles_completed,
+            'arm_utilisation': self.arm_busy_time / self.duration,
+            'mean_queue_delay': statistics.mean(delays) if delays else 0.0,
+            'p95_queue_delay': delays[int(0.95 * (len(delays) - 1))] if delays else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capacity planning simulator for machine tending cells")
+    parser.add_argument('log_file', help="control loop or supervisor output containing cycle_stats lines")
+    parser.add_argument('--printers', type=int, nargs='+', default=[1])
+    parser.add_argument('--pick-temp', type=float, nargs='+', default=None,
+                        help="pick temps to simulate (default: the recorded pick temp)")
+    parser.add_argument('--arm-speed', type=float, nargs='+', default=[1.0],
+                        help="pick and place speed relative to the recorded runs")
+    parser.add_argument('--batch', type=int, nargs='+', default=[1], help="parts per batch")
+    parser.add_argument('--recorded-batch', type=int, default=1, help="parts per batch in the recorded runs")
+    parser.add_argument('--pick-fixed-fraction', type=float, default=PICK_FIXED_FRACTION,
+                        help="share of the recorded pick and place time spent once per visit (approach, "
+                             "retreat, handshake) rather than per part, between 0 and 1 (default: %(default)s)")
+    parser.add_argument('--days', type=float, default=SIMULATED_DAYS)
+    parser.add_argument('--bed-temp', type=float, default=BED_TEMP)
+    parser.add_argument('--ambient-temp', type=float, default=AMBIENT_TEMP)
+    parser.add_argument('--cooling-time-constant', type=float, default=BED_COOLING_TIME_CONSTANT,
+                        help="bed cooling time constant in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cycles, pick_temps = read_cycle_stats(args.log_file)
+    if not cycles:
+        parser.error("no cycle_stats found in {0}".format(args.log_file))
+    baseline_pick_temp = statistics.mean(pick_temps) if pick_temps else BASELINE_PICK_TEMP
+    # Newton's law of cooling never brings the bed down to ambient
+    for pick_temp in [baseline_pick_temp] + (args.pick_temp or []):
+        if pick_temp <= args.ambient_temp:
+            parser.error("pick temp {0} C must be above the ambient temp {1} C".format(pick_temp, args.ambient_temp))
+    if not 0 <= args.pick_fixed_fraction <= 1:
+        parser.error("--pick-fixed-fraction must be between 0 and 1")
+    model = CellModel(cycles, baseline_pick_temp, args.recorded_batch, args.bed_temp, args.ambient_temp,
+                      args.cooling_time_constant, args.pick_fixed_fraction)
+    print("fitted {0} recorded cycles, recorded pick temp {1:.1f} C".format(len(cycles), baseline_pick_temp))
+
+    print("{0:>8} {1:>9} {2:>9} {3:>5} {4:>11} {5:>8} {6:>9} {7:>12} {8:>11}".format(
+        'printers', 'pick temp', 'arm speed', 'batch', 'parts/hour', 'cycles', 'arm util',
+        'mean queue s', 'p95 queue s'))
+    for printers, pick_temp, arm_speed, batch_size in itertools.product(
+            args.printers, args.pick_temp or [baseline_pick_temp], args.arm_speed, args.batch):
+        scenario = Scenario(printers, pick_temp, arm_speed, batch_size)
+        report = Simulation(model, scenario, args.days * 24 * 3600, args.seed).run().report()
+        print("{0:>8} {1:>9.1f} {2:>9.2f} {3:>5} {4:>11.2f} {5:>8} {6:>8.1%} {7:>12.1f} {8:>11.1f}".format(
+            printers, pick_temp, arm_speed, batch_size, report['parts_per_hour'], report['cycles'],
+            report['arm_utilisation'], report['mean_queue_delay'], report['p95_queue_delay']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import math
+
+# Default Parameters for the Cycle Statistics Engine
+EWMA_ALPHA = 0.3
+DRIFT_QUANTILE = 0.95
+# below this many samples quantiles are computed exactly, and the drift alarm stays off
+EXACT_QUANTILE_SAMPLES = 20
+DRIFT_MIN_SAMPLES = EXACT_QUANTILE_SAMPLES
+ETA_CONFIDENCE_Z = 1.96
+
+PHASES = ('printing', 'cooling', 'pick_and_place')
+
+
+class RunningStats:
+    """
+    Welford's online mean and variance.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+
+class Ewma:
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.value + self.alpha * (x - self.value)
+
+
+def exact_quantile(sorted_samples, p):
+    h = (len(sorted_samples) - 1) * p
+    lo = int(h)
+    if lo + 1 >= len(sorted_samples):
+        return sorted_samples[lo]
+    return sorted_samples[lo] + (h - lo) * (sorted_samples[lo + 1] - sorted_samples[lo])
+
+
+class P2Quantile:
+    """
+    Streaming quantile estimate in constant space (Jain and Chlamtac's P-square algorithm).
+    The first exact_samples samples are kept and the quantile computed exactly, then the
+    five P-square markers are placed on them, since markers started from only five samples
+    take many updates to move away from the median.
+    """
+
+    def __init__(self, p, exact_samples=EXACT_QUANTILE_SAMPLES):
+        self.p = p
+        self.exact_samples = max(exact_samples, 5)
+        self.samples = []
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def start_markers(self):
+        q = sorted(self.samples)
+        n = len(q)
+        self.desired = [1 + (n - 1) * increment for increment in self.increments]
+        # marker positions must be distinct ranks, however close p is to 0 or 1
+        positions = [int(round(d)) for d in self.desired]
+        for i in range(1, 4):
+            positions[i] = max(positions[i], positions[i - 1] + 1)
+        for i in range(3, 0, -1):
+            positions[i] = min(positions[i], positions[i + 1] - 1)
+        self.positions = positions
+        self.heights = [q[position - 1] for position in positions]
+        self.samples = None
+
+    def update(self, x):
+        if self.heights is None:
+            self.samples.append(x)
+            if len(self.samples) >= self.exact_samples:
+                self.start_markers()
+            return
+        q = self.heights
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(1, 5) if x < q[i]) - 1
+
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] += d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    @property
+    def value(self):
+        if self.heights is None:
+            return exact_quantile(sorted(self.samples), self.p) if self.samples else None
+        return self.heights[2]
+
+
+class PhaseStats:
+
+    def __init__(self):
+        self.running = RunningStats()
+        self.recent = Ewma()
+        self.median = P2Quantile(0.5)
+        self.upper = P2Quantile(DRIFT_QUANTILE)
+        self.drifting = False
+
+    def update(self, duration):
+        # compare the recent average with the distribution seen before this cycle
+        historical_upper = self.upper.value
+        self.running.update(duration)
+        self.recent.update(duration)
+        self.median.update(duration)
+        self.upper.update(duration)
+        self.drifting = (self.running.count > DRIFT_MIN_SAMPLES and historical_upper is not None and
+                         self.recent.value > historical_upper)
+
+
+class CycleStatsEngine:
+    """
+    Incremental per-phase statistics from the control loop's cycle_stats timestamps,
+    O(1) per cycle, with a completion estimate for the remaining jobs.
+    """
+
+    def __init__(self):
+        self.phases = {phase: PhaseStats() for phase in PHASES}
+        self.cycle = PhaseStats()
+
+    def update(self, cycle_stats):
+        durations = [cycle_stats[i + 1] - cycle_stats[i] for i in range(len(cycle_stats) - 1)]
+        for phase, duration in zip(PHASES, durations):
+            self.phases[phase].update(duration)
+        self.cycle.update(cycle_stats[-1] - cycle_stats[0])
+
+    def eta(self, remaining_cycles):
+        """
+        Returns (estimate, low, high) in seconds for the remaining cycles, or None before the first cycle.
+        The estimate follows recent cycle times; the band assumes independent cycles.
+        """
+        if self.cycle.recent.value is None:
+            return None
+        estimate = self.cycle.recent.value * remaining_cycles
+        margin = ETA_CONFIDENCE_Z * self.cycle.running.stdev * math.sqrt(remaining_cycles)
+        return estimate, max(estimate - margin, 0.0), estimate + margin
+
+    def drifting_phases(self):
+        return [phase for phase in PHASES if self.phases[phase].drifting]
@@ -0,0 +1,246 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+CONTROL_LOOP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mt_control_loop.py')
+RTDE_CONFIG_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'control_loop_configuration.xml')
+
+# Default Parameters for the Supervisor
+HEALTH_CHECK_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 30.0
+RESTART_BACKOFF_INITIAL = 1.0
+RESTART_BACKOFF_MAX = 60.0
+SHUTDOWN_TIMEOUT = 10.0
+
+output_lock = threading.Lock()
+
+
+def write_line(stream, message):
+    # worker reader threads share the supervisor's stdout and stderr, so write whole lines under a lock
+    with output_lock:
+        stream.write(message)
+        stream.write('\n')
+        stream.flush()
+
+
+class SupervisorConfig:
+    """
+    Reads the cell manifest, e.g.
+    {"cells": [{"name": "exhibit", "app_config": "exhibit/app_config.json", "cpu_affinity": [2]}, ...]}
+    Paths are relative to the manifest; rtde_config defaults to control_loop_configuration.xml.
+    """
+    def __init__(self, manifest_json):
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_json))
+        manifest = json.load(open(manifest_json))
+
+        self.health_check_interval = manifest.get('health_check_interval', HEALTH_CHECK_INTERVAL)
+        self.heartbeat_timeout = manifest.get('heartbeat_timeout', HEARTBEAT_TIMEOUT)
+        self.restart_backoff_initial = manifest.get('restart_backoff_initial', RESTART_BACKOFF_INITIAL)
+        self.restart_backoff_max = manifest.get('restart_backoff_max', RESTART_BACKOFF_MAX)
+        self.shutdown_timeout = manifest.get('shutdown_timeout', SHUTDOWN_TIMEOUT)
+
+        self.cells = []
+        for cell in manifest['cells']:
+            self.cells.append(CellConfig(
+                name=cell['name'],
+                app_config_file=os.path.join(manifest_dir, cell['app_config']),
+                rtde_config_file=os.path.join(manifest_dir, cell['rtde_config']) if 'rtde_config' in cell
+                else RTDE_CONFIG_XML,
+                cpu_affinity=cell.get('cpu_affinity')))
+
+        names = [cell.name for cell in self.cells]
+        if len(set(names)) != len(names):
+            raise ValueError("cell names in {0} must be unique".format(manifest_json))
+
+        # metrics are opt-in per cell, but two cells serving on one port would leave one of them unscraped
+        ports = {}
+        for cell in self.cells:
+            port = cell.metrics_port()
+            if port is not None and port in ports:
+                raise ValueError("cells {0} and {1} both use metrics port {2}".format(ports[port], cell.name, port))
+            ports[port] = cell.name
+
+        if hasattr(os, 'sched_getaffinity'):
+            available_cpus = os.sched_getaffinity(0)
+            for cell in self.cells:
+                if cell.cpu_affinity and not cell.cpu_affinity <= available_cpus:
+                    raise ValueError("cpu_affinity of cell {0} is not a subset of the available cpus {1}".format(
+                        cell.name, sorted(available_cpus)))
+
+
+class CellConfig:
+    def __init__(self, name, app_config_file, rtde_config_file, cpu_affinity=None):
+        self.name = name
+        self.app_config_file = app_config_file
+        self.rtde_config_file = rtde_config_file
+        self.cpu_affinity = set(cpu_affinity) if cpu_affinity else None
+
+    def metrics_port(self):
+        return json.load(open(self.app_config_file)).get('metrics_port')
+
+
+class CellWorker:
+    STATE_STARTING = "STARTING"
+    STATE_RUNNING = "RUNNING"
+    STATE_BACKOFF = "BACKOFF"
+    STATE_FINISHED = "FINISHED"
+    STATE_STOPPED = "STOPPED"
+
+    def __init__(self, cell_config, supervisor_config):
+        self.cell = cell_config
+        self.config = supervisor_config
+        self.process = None
+        self.state = None
+        self.restart_count = 0
+        self.backoff = supervisor_config.restart_backoff_initial
+        self.next_start_time = 0
+        self.start_time = None
+        self.last_heartbeat = None
+        # progress reported by the worker, passed on to its replacement so a restart resumes the job count
+        self.print_job_count = 0
+        self.cycle_phase = None
+        self.stdout_thread = None
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            write_line(sys.stdout, "cell_status={0},{1},{2},{3}".format(
+                self.cell.name, state, self.process.pid if self.process else '', self.restart_count))
+
+    def start(self):
+        args = [sys.executable, CONTROL_LOOP_SCRIPT, self.cell.app_config_file, self.cell.rtde_config_file, "True",
+                str(self.print_job_count), self.cycle_phase or '']
+        if self.cell.cpu_affinity:
+            if hasattr(os, 'sched_setaffinity'):
+                # the control loop pins itself before it starts any threads
+                args.append(",".join(str(cpu) for cpu in sorted(self.cell.cpu_affinity)))
+            else:
+                write_line(sys.stderr, "[{0}] cpu affinity not supported on this platform".format(self.cell.name))
+
+        try:
+            self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            universal_newlines=True, bufsize=1)
+        except (OSError, subprocess.SubprocessError) as e:
+            self.process = None
+            self.schedule_restart("could not start control loop: {0}".format(e))
+            return
+        self.start_time = time.monotonic()
+        self.last_heartbeat = self.start_time
+        self.stdout_thread = threading.Thread(target=self.relay_stdout, args=(self.process.stdout,), daemon=True)
+        self.stdout_thread.start()
+        threading.Thread(target=self.relay_stderr, args=(self.process.stderr,), daemon=True).start()
+        self.set_state(CellWorker.STATE_STARTING)
+
+    def relay_stdout(self, stream):
+        for line in stream:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            # any output from the worker, including the watchdog thread's current_time, counts as a heartbeat
+            self.last_heartbeat = time.monotonic()
+            name, sep, value = line.partition('=')
+            if name == 'print_job_count':
+                self.print_job_count = int(value)
+                self.cycle_phase = None
+            elif name == 'cycle_phase':
+                self.cycle_phase = value
+            write_line(sys.stdout, "{0}.{1}".format(self.cell.name, line))
+
+    def relay_stderr(self, stream):
+        for line in stream:
+            line = line.rstrip('\n')
+            if line:
+                write_line(sys.stderr, "[{0}] {1}".format(self.cell.name, line))
+
+    def stop(self, timeout):
+        if self.process is None or self.process.poll() is not None:
+            return
+        # SIGTERM lets the control loop's GracefulKiller finish the current step
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def schedule_restart(self, reason):
+        write_line(sys.stderr, "[{0}] {1}, restarting in {2:.1f} sec".format(self.cell.name, reason, self.backoff))
+        self.next_start_time = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.config.restart_backoff_max)
+        self.restart_count += 1
+        self.set_state(CellWorker.STATE_BACKOFF)
+
+    def health_check(self):
+        now = time.monotonic()
+
+        if self.state == CellWorker.STATE_BACKOFF:
+            # wait for the previous worker's last lines, so its replacement starts from its final progress
+            if now >= self.next_start_time and not (self.stdout_thread and self.stdout_thread.is_alive()):
+                self.start()
+            return
+
+        if self.state in (CellWorker.STATE_FINISHED, CellWorker.STATE_STOPPED):
+            return
+
+        exit_code = self.process.poll()
+        if exit_code is not None:
+            if exit_code == 0:
+                write_line(sys.stderr, "[{0}] control loop finished".format(self.cell.name))
+                self.set_state(CellWorker.STATE_FINISHED)
+            else:
+                self.schedule_restart("control loop exited with code {0}".format(exit_code))
+            return
+
+        if now - self.last_heartbeat > self.config.heartbeat_timeout:
+            self.stop(self.config.shutdown_timeout)
+            self.schedule_restart("no heartbeat for {0:.0f} sec".format(now - self.last_heartbeat))
+            return
+
+        if self.last_heartbeat > self.start_time:
+            self.set_state(CellWorker.STATE_RUNNING)
+        if now - self.start_time > self.config.restart_backoff_max:
+            # the worker has been healthy long enough that the next crash starts a fresh backoff sequence
+            self.backoff = self.config.restart_backoff_initial
+
+
+class Supervisor:
+
+    def __init__(self, supervisor_config):
+        self.config = supervisor_config
+        self.workers = [CellWorker(cell, supervisor_config) for cell in supervisor_config.cells]
+        self.stop_now = False
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+    def exit_gracefully(self, *args):
+        self.stop_now = True
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+
+        while not self.stop_now:
+            for worker in self.workers:
+                worker.health_check()
+            if all(worker.state == CellWorker.STATE_FINISHED for worker in self.workers):
+                break
+            time.sleep(self.config.health_check_interval)
+
+        for worker in self.workers:
+            worker.stop(self.config.shutdown_timeout)
+            if worker.state != CellWorker.STATE_FINISHED:
+                worker.set_state(CellWorker.STATE_STOPPED)
+
+
+def main():
+    args = sys.argv[1:]
+    supervisor = Supervisor(SupervisorConfig(args[0]))
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import os
+
+# Default Parameters for the Pick Temperature Tuner
+PICK_TEMP_MIN = 25
+PICK_TEMP_MAX = 60
+PICK_TEMP_MARGIN = 5
+PICK_TEMP_STEP = 1
+SLOW_PICK_FACTOR = 1.5
+PICK_DURATION_SMOOTHING = 0.2
+CEILING_RELAX_PICKS = 10
+
+
+class PickTempTuner:
+    """
+    Adjusts the printer bed pick temperature from the outcome of each pick.
+    A clean pick raises the threshold by one step, a failed pick lowers it by
+    two steps and caps future increases just below the failing temperature,
+    and a pick that succeeds but takes much longer than usual lowers it by one step.
+    After CEILING_RELAX_PICKS clean picks in a row the cap rises a step, so a failure
+    that had nothing to do with temperature does not cap the part for good.
+    Unless max_temp is given, the threshold stays within PICK_TEMP_MARGIN of the baseline.
+    State is kept per printer and gcode file in a json file between sessions.
+    """
+
+    def __init__(self, tuning_file, key, baseline_temp, min_temp=PICK_TEMP_MIN, max_temp=None,
+                 step=PICK_TEMP_STEP):
+        self.tuning_file = tuning_file
+        self.key = key
+        self.baseline_temp = baseline_temp
+        self.min_temp = min_temp
+        self.configured_max_temp = max_temp
+        self.max_temp = self.upper_limit(baseline_temp)
+        self.step = step
+
+        state = self.load().get(key, {})
+        self.threshold = self.clamp(state.get('threshold', baseline_temp))
+        self.ceiling = self.clamp(state.get('ceiling', self.max_temp))
+        self.pick_duration = state.get('pick_duration')
+        self.clean_picks = state.get('clean_picks', 0)
+        self.cooling_time_saved = state.get('cooling_time_saved', 0)
+
+    def set_baseline(self, baseline_temp):
+        # an operator-chosen pick temperature restarts tuning from that value
+        self.baseline_temp = baseline_temp
+        self.max_temp = self.upper_limit(baseline_temp)
+        self.threshold = self.clamp(baseline_temp)
+        self.ceiling = self.max_temp
+        self.clean_picks = 0
+
+    def upper_limit(self, baseline_temp):
+        # a warmer pick risks deforming the part, so only explore a few degrees above the operator's choice
+        if self.configured_max_temp is not None:
+            return self.configured_max_temp
+        return min(PICK_TEMP_MAX, baseline_temp + PICK_TEMP_MARGIN)
+
+    def clamp(self, temp):
+        return max(self.min_temp, min(self.max_temp, temp))
+
+    def load(self):
+        # tuning state is only an optimisation, so an unreadable file starts tuning afresh
+        try:
+            with open(self.tuning_file) as f:
+                tuning = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return tuning if isinstance(tuning, dict) else {}
+
+    def save(self):
+        tuning = self.load()
+        tuning[self.key] = {'threshold': self.threshold,
+                            'ceiling': self.ceiling,
+                            'pick_duration': self.pick_duration,
+                            'clean_picks': self.clean_picks,
+                            'cooling_time_saved': self.cooling_time_saved}
+        tmp_file = self.tuning_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(tuning, f, indent=2)
+        os.replace(tmp_file, self.tuning_file)
+
+    def estimate_cooling_time_saved(self, cooling_rate):
+        # cooling_rate in C/sec, measured over this cycle's wait for the bed to reach the threshold.
+        # Picking below the baseline saves nothing rather than counting against earlier savings.
+        if not cooling_rate or cooling_rate <= 0:
+            return 0
+        return max(self.threshold - self.baseline_temp, 0) / cooling_rate
+
+    def record_pick(self, succeeded, pick_duration, cooling_rate=None):
+        """
+        Returns the estimated cooling time saved on this cycle (sec), relative to the baseline temperature.
+        """
+        saved = self.estimate_cooling_time_saved(cooling_rate)
+        self.cooling_time_saved += saved
+
+        if succeeded is None:
+            # the cobot did not report an outcome, leave the threshold alone
+            pass
+        elif not succeeded:
+            self.ceiling = self.clamp(self.threshold - self.step)
+            self.threshold = self.clamp(self.threshold - 2 * self.step)
+            self.clean_picks = 0
+        elif self.pick_duration is not None and pick_duration > SLOW_PICK_FACTOR * self.pick_duration:
+            # part released, but only with effort: back off rather than waiting for it to stick
+            self.threshold = self.clamp(self.threshold - self.step)
+            self.clean_picks = 0
+        else:
+            if self.pick_duration is None:
+                self.pick_duration = pick_duration
+            else:
+                self.pick_duration += PICK_DURATION_SMOOTHING * (pick_duration - self.pick_duration)
+            self.clean_picks += 1
+            if self.clean_picks >= CEILING_RELAX_PICKS and self.ceiling < self.max_temp:
+                self.ceiling = self.clamp(self.ceiling + self.step)
+                self.clean_picks = 0
+            self.threshold = min(self.ceiling, self.clamp(self.threshold + self.step))
+
+        self.save()
+        return saved
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from mt_gcode import GcodeOffsetter, batch_offsets, read_sections, tile_gcode, write_batch_gcode
+
+HEADER = """M82
+G28
+G1 Z15 F3000
+"""
+
+PRIME_LINE = """G1 X0.1 Y20 Z0.3 F5000
+G1 X0.1 Y200 E15 F1500
+G92 E0
+"""
+
+BODY = """;LAYER:0
+G0 F3000 X10 Y10 Z0.2
+G1 X20 Y10 E1.5
+G1 X20 Y20 E3
+;LAYER:1
+G0 X10 Y10 Z0.4
+G1 X20 Y10 E4.5
+;MT_BATCH_END
+"""
+
+FOOTER = """G91
+G1 E-2 Z0.2
+G90
+M84
+"""
+
+
+@pytest.fixture
+def gcode_files(tmp_path):
+    first = tmp_path / "first.gcode"
+    first.write_text(HEADER + PRIME_LINE + BODY + FOOTER)
+    part = tmp_path / "part.gcode"
+    part.write_text(HEADER + BODY + FOOTER)
+    return str(first), str(part)
+
+
+def commands(lines):
+    return [line.partition(';')[0].strip() for line in lines if line.partition(';')[0].strip()]
+
+
+def test_offsetter_shifts_absolute_xy_only():
+    offsetter = GcodeOffsetter(40, 10)
+    assert offsetter.transform("G1 X20 Y10.5 Z0.2 E1.5 F1200 ; infill\n") == "G1 X60 Y20.5 Z0.2 E1.5 F1200 ; infill\n"
+    assert offsetter.transform("G91\n") == "G91\n"
+    assert offsetter.transform("G1 X5 Y5\n") == "G1 X5 Y5\n"
+
+
+def test_offsetter_tracks_relative_z():
+    offsetter = GcodeOffsetter()
+    offsetter.transform("G1 Z10\n")
+    offsetter.transform("G91\n")
+    offsetter.transform("G1 Z5\n")
+    offsetter.transform("G90\n")
+    assert offsetter.z == 15
+    assert offsetter.max_z == 15
+
+
+def test_read_sections_splits_at_markers(gcode_files):
+    sections = [section for section, line in read_sections(gcode_files[1], ";LAYER:0", ";MT_BATCH_END")]
+    assert sections == ['header'] * 3 + ['body'] * 7 + ['footer'] * 5
+
+
+def test_read_sections_requires_markers(tmp_path):
+    gcode_file = tmp_path / "unmarked.gcode"
+    gcode_file.write_text(HEADER + FOOTER)
+    with pytest.raises(ValueError):
+        list(read_sections(str(gcode_file), ";LAYER:0", ";MT_BATCH_END"))
+
+
+def test_tile_gcode_interleaves_layers(gcode_files):
+    lines = list(tile_gcode(gcode_files[0], gcode_files[1], batch_offsets(2)))
+    markers = [line.strip() for line in lines if line.startswith(';LAYER:') or line.startswith(';MT_BATCH_PART')]
+    assert markers == [';LAYER:0', ';MT_BATCH_PART:1', ';LAYER:0', ';MT_BATCH_PART:0', ';LAYER:1',
+                       ';MT_BATCH_PART:1', ';LAYER:1']
+    # the prime line and footer appear once
+    assert commands(lines).count("G1 X0.1 Y200 E15 F1500") == 1
+    assert commands(lines).count("M84") == 1
+
+
+def test_tile_gcode_offsets_copies(gcode_files):
+    lines = commands(tile_gcode(gcode_files[0], gcode_files[1], batch_offsets(2)))
+    assert lines.count("G1 X20 Y10 E1.5") == 1
+    assert lines.count("G1 X60 Y10 E1.5") == 1
+
+
+def test_tile_gcode_resumes_extruder_and_lifts_between_copies(gcode_files):
+    lines = commands(tile_gcode(gcode_files[0], gcode_files[1], batch_offsets(2), travel_clearance=5))
+    second_layer = lines.index("G0 X10 Y10 Z0.4")
+    # back to copy 0 after copy 1's first layer: lift above the batch, travel, drop and restore E
+    assert lines[second_layer - 7:second_layer] == ["G90", "G0 F600 Z5.2", "G0 F6000 X20 Y20", "G0 F600 Z0.2",
+                                                    "M82", "G92 E3.00000", "G1 F3000"]
+
+
+def test_write_batch_gcode_rejects_parts_off_the_bed(gcode_files, tmp_path):
+    output_file = str(tmp_path / "batch.gcode")
+    with pytest.raises(ValueError):
+        write_batch_gcode(output_file, gcode_files[0], gcode_files[1], batch_offsets(2), bed_size_x=50)
+    assert not os.path.exists(output_file)
+    assert not os.path.exists(output_file + '.tmp')
+
+
+def test_write_batch_gcode_rejects_overlapping_parts(gcode_files, tmp_path):
+    with pytest.raises(ValueError):
+        write_batch_gcode(str(tmp_path / "batch.gcode"), gcode_files[0], gcode_files[1],
+                          batch_offsets(2, spacing_x=5))
+
+
+def test_write_batch_gcode_requires_markers(gcode_files, tmp_path):
+    unmarked = tmp_path / "unmarked.gcode"
+    unmarked.write_text(HEADER + FOOTER)
+    output_file = str(tmp_path / "batch.gcode")
+    with pytest.raises(ValueError):
+        write_batch_gcode(output_file, gcode_files[0], str(unmarked), batch_offsets(2))
+    assert not os.path.exists(output_file + '.tmp')
@@ -0,0 +1,162 @@
+import email.parser
+import hashlib
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+from mt_gcode_sync import GCODE_CACHE_DIR, GCODE_MANIFEST_FILE, GcodeManifest, MultipartFileStream, file_sha1
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class FakePrinterClient:
+    """
+    Stands in for PrinterClient, keeping the OctoPrint Server's files in a dict.
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.uploads = []
+        self.downloads = []
+
+    def get_file_info(self, filename):
+        if filename not in self.files:
+            return None
+        return {'name': filename, 'hash': sha1(self.files[filename])}
+
+    def upload_gcode(self, path):
+        self.uploads.append(os.path.basename(path))
+        with open(path, 'rb') as f:
+            self.files[os.path.basename(path)] = f.read()
+
+    def download_gcode(self, filename, path):
+        self.downloads.append(filename)
+        with open(path, 'wb') as f:
+            f.write(self.files[filename])
+
+
+def test_file_sha1_matches_hashlib(tmp_path):
+    gcode_file = tmp_path / "part.gcode"
+    gcode_file.write_bytes(b"G28\n" * 100000)
+    assert file_sha1(str(gcode_file)) == sha1(b"G28\n" * 100000)
+
+
+def test_multipart_file_stream_round_trip(tmp_path):
+    data = b"G1 X10 Y10\n" * 20000
+    gcode_file = tmp_path / "part.gcode"
+    gcode_file.write_bytes(data)
+    stream = MultipartFileStream(str(gcode_file))
+
+    chunks = []
+    chunk = stream.read(1000)
+    while chunk:
+        chunks.append(chunk)
+        chunk = stream.read(1000)
+    body = b"".join(chunks)
+    assert len(body) == len(stream)
+
+    message = email.parser.BytesParser().parsebytes(
+        b"Content-Type: " + stream.content_type.encode('utf8') + b"\r\n\r\n" + body)
+    parts = message.get_payload()
+    assert len(parts) == 1
+    assert parts[0].get_filename() == "part.gcode"
+    assert parts[0].get_payload(decode=True) == data
+
+
+def test_multipart_file_stream_reads_whole_body(tmp_path):
+    gcode_file = tmp_path / "part.gcode"
+    gcode_file.write_bytes(b"M84\n")
+    stream = MultipartFileStream(str(gcode_file))
+    assert len(stream.read()) == len(stream)
+    assert stream.read() == b""
+
+
+def test_manifest_caches_hash_until_file_changes(tmp_path):
+    gcode_file = tmp_path / "part.gcode"
+    gcode_file.write_bytes(b"G28\n")
+    manifest = GcodeManifest(str(tmp_path))
+    assert manifest.local_hash(str(gcode_file)) == sha1(b"G28\n")
+    manifest.save()
+
+    manifest = GcodeManifest(str(tmp_path))
+    manifest.entries["part.gcode"]['hash'] = "cached"
+    assert manifest.local_hash(str(gcode_file)) == "cached"
+
+    gcode_file.write_bytes(b"G28\nM84\n")
+    assert manifest.local_hash(str(gcode_file)) == sha1(b"G28\nM84\n")
+
+
+def test_manifest_ignores_unreadable_file(tmp_path):
+    (tmp_path / GCODE_MANIFEST_FILE).write_text('{"part.gcode": {"size"')
+    manifest = GcodeManifest(str(tmp_path))
+    assert manifest.entries == {}
+    manifest.save()
+    assert GcodeManifest(str(tmp_path)).entries == {}
+
+
+@pytest.fixture
+def control_loop(tmp_path):
+    for module in ('requests', 'rtde', 'octorest'):
+        pytest.importorskip(module)
+    from mt_control_loop import ControlLoop
+    gcode_dir = tmp_path / "gcode"
+    gcode_dir.mkdir()
+    return ControlLoop(SimpleNamespace(gcode_dir=str(gcode_dir)))
+
+
+def test_sync_uploads_operator_file_on_mismatch(control_loop):
+    gcode_path = os.path.join(control_loop.app_config.gcode_dir, "part.gcode")
+    with open(gcode_path, 'wb') as f:
+        f.write(b"new")
+    printer_client = FakePrinterClient({"part.gcode": b"old"})
+    assert control_loop.sync_gcode_files(printer_client, ["part.gcode"])
+    assert printer_client.uploads == ["part.gcode"]
+    assert printer_client.files["part.gcode"] == b"new"
+
+    # verified and unchanged, so the next sync leaves the server alone
+    assert control_loop.sync_gcode_files(printer_client, ["part.gcode"])
+    assert printer_client.uploads == ["part.gcode"]
+
+
+def test_sync_fails_when_upload_does_not_verify(control_loop):
+    gcode_path = os.path.join(control_loop.app_config.gcode_dir, "part.gcode")
+    with open(gcode_path, 'wb') as f:
+        f.write(b"new")
+    printer_client = FakePrinterClient({"part.gcode": b"old"})
+    printer_client.upload_gcode = lambda path: None
+    assert not control_loop.sync_gcode_files(printer_client, ["part.gcode"])
+
+
+def test_sync_without_local_copy_requires_server_file(control_loop):
+    printer_client = FakePrinterClient({"part.gcode": b"old"})
+    assert control_loop.sync_gcode_files(printer_client, ["part.gcode"])
+    assert not control_loop.sync_gcode_files(printer_client, ["missing.gcode"])
+    assert printer_client.uploads == []
+
+
+def test_cached_download_is_refreshed_and_never_uploaded(control_loop):
+    printer_client = FakePrinterClient({"part.gcode": b"v1"})
+    cache_path = control_loop.local_gcode_path(printer_client, "part.gcode")
+    assert cache_path == os.path.join(control_loop.app_config.gcode_dir, GCODE_CACHE_DIR, "part.gcode")
+    assert control_loop.local_gcode_path(printer_client, "part.gcode") == cache_path
+    assert printer_client.downloads == ["part.gcode"]
+
+    printer_client.files["part.gcode"] = b"v2 is newer"
+    control_loop.local_gcode_path(printer_client, "part.gcode")
+    with open(cache_path, 'rb') as f:
+        assert f.read() == b"v2 is newer"
+
+    assert control_loop.sync_gcode_files(printer_client, ["part.gcode"])
+    assert printer_client.uploads == []
+
+
+def test_operator_file_takes_precedence_over_cache(control_loop):
+    printer_client = FakePrinterClient({"part.gcode": b"server"})
+    control_loop.local_gcode_path(printer_client, "part.gcode")
+    gcode_path = os.path.join(control_loop.app_config.gcode_dir, "part.gcode")
+    shutil.copy(os.path.join(control_loop.app_config.gcode_dir, GCODE_CACHE_DIR, "part.gcode"), gcode_path)
+    assert control_loop.local_gcode_path(printer_client, "part.gcode") == gcode_path
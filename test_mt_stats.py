@@ -0,0 +1,102 @@
+import random
+import statistics
+
+import pytest
+
+from mt_stats import CycleStatsEngine, Ewma, P2Quantile, PhaseStats, RunningStats, exact_quantile, \
+    DRIFT_MIN_SAMPLES
+
+
+def test_running_stats_matches_statistics():
+    rng = random.Random(0)
+    samples = [rng.gauss(600, 30) for _ in range(500)]
+    running = RunningStats()
+    for x in samples:
+        running.update(x)
+    assert running.count == 500
+    assert running.mean == pytest.approx(statistics.mean(samples))
+    assert running.variance == pytest.approx(statistics.variance(samples))
+    assert running.stdev == pytest.approx(statistics.stdev(samples))
+
+
+def test_running_stats_single_sample_has_no_spread():
+    running = RunningStats()
+    running.update(42)
+    assert running.mean == 42
+    assert running.stdev == 0.0
+
+
+def test_ewma_follows_recent_values():
+    ewma = Ewma(alpha=0.5)
+    assert ewma.value is None
+    for x in (10, 20, 20):
+        ewma.update(x)
+    assert ewma.value == 17.5
+
+
+def test_exact_quantile_interpolates():
+    assert exact_quantile([1, 2, 3, 4], 0.5) == 2.5
+    assert exact_quantile([1, 2, 3, 4], 1.0) == 4
+    assert exact_quantile([7], 0.95) == 7
+
+
+def test_p2_quantile_is_exact_for_few_samples():
+    quantile = P2Quantile(0.95)
+    assert quantile.value is None
+    samples = [600 + 10 * i for i in range(10)]
+    for x in reversed(samples):
+        quantile.update(x)
+    # with few samples the upper quantile must not collapse to the median
+    assert quantile.value == pytest.approx(exact_quantile(samples, 0.95))
+
+
+@pytest.mark.parametrize('p', [0.5, 0.95])
+def test_p2_quantile_tracks_large_samples(p):
+    rng = random.Random(1)
+    samples = [rng.gauss(600, 30) for _ in range(5000)]
+    quantile = P2Quantile(p)
+    for x in samples:
+        quantile.update(x)
+    assert quantile.value == pytest.approx(exact_quantile(sorted(samples), p), abs=5)
+
+
+def test_eta_band():
+    engine = CycleStatsEngine()
+    assert engine.eta(10) is None
+    start = 0
+    for duration in (590, 610, 600, 600):
+        engine.update([start, start + duration - 100, start + duration - 50, start + duration])
+        start += duration
+    estimate, low, high = engine.eta(4)
+    assert low < estimate < high
+    assert estimate == pytest.approx(engine.cycle.recent.value * 4)
+    assert high - estimate == pytest.approx(1.96 * engine.cycle.running.stdev * 2)
+    assert engine.eta(0) == (0.0, 0.0, 0.0)
+
+
+def test_no_drift_alarm_on_stationary_input():
+    false_alarms = 0
+    for seed in range(200):
+        rng = random.Random(seed)
+        phase = PhaseStats()
+        for cycle in range(50):
+            phase.update(rng.gauss(600, 30))
+            false_alarms += phase.drifting
+            if cycle < DRIFT_MIN_SAMPLES:
+                assert not phase.drifting
+    # fewer than 1 cycle in 200 raises a false alarm
+    assert false_alarms < 200 * 50 / 200
+
+
+def test_drift_alarm_on_slower_phase():
+    rng = random.Random(2)
+    engine = CycleStatsEngine()
+    start = 0
+    alarms = []
+    for cycle in range(35):
+        cooling = rng.gauss(600, 30) if cycle < 30 else rng.gauss(750, 30)
+        engine.update([start, start + 3600, start + 3600 + cooling, start + 3660 + cooling])
+        start += 3660 + cooling
+        alarms.append(engine.drifting_phases())
+    assert all(not drifting for drifting in alarms[:30])
+    assert ['cooling'] in alarms[30:]